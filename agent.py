@@ -8,25 +8,45 @@ import os
 import os.path
 import errno
 import socket
+import select
+import threading
 import time
+import timeit
 import datetime
-import json
 import contextlib
+import collections
+import hashlib
+import hmac
 import logging
 import fasteners
 import daemon
 
 import pinentry
 import hashpasslib
-
-# Set up logging.
-logging.basicConfig(filename="./agent.log", level=logging.DEBUG, disabled=True)
-logging.getLogger().disabled = True
+import alg
+import agent_protocol
+import ttlcache
 
 
 # Credential lifetime in seconds.
 CREDENTIALS_LIFETIME = datetime.timedelta(hours=12).total_seconds()
 
+# Seconds between checks for shutdown while waiting for connections.
+ACCEPT_POLL_INTERVAL = 1
+
+# Maximum number of intermediates to hold at once.
+INTERMEDIATE_CACHE_SIZE = 4
+
+# Number of passwords to derive at a time for get_passwords.
+PASSWORDS_CHUNK_SIZE = 64
+
+# Requests with an id served at once per connection. Reading more
+# requests from the connection waits for a free slot.
+REQUESTS_PER_CONNECTION = 8
+
+# Message types which get their own stats.
+MESSAGE_TYPES = ("ping", "get_password", "get_passwords", "stats", "shutdown")
+
 
 class AgentLockException(Exception):
     pass
@@ -39,20 +59,8 @@ def log_exception(exc_type, exc_value, exc_traceback):
 sys.excepthook = log_exception
 
 
-def daemon_dir_path():
-    return os.path.abspath("/tmp/hashpass-{}.d".format(os.getuid()))
-
-
-def daemon_lock_path():
-    return os.path.join(daemon_dir_path(), "agent.lock")
-
-
-def daemon_sock_path():
-    return os.path.join(daemon_dir_path(), "agent.sock")
-
-
 def create_daemon_dir():
-    path = daemon_dir_path()
+    path = agent_protocol.daemon_dir_path()
 
     try:
         os.mkdir(path, 0700)
@@ -103,57 +111,317 @@ def make_server_socket(path):
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     sock.bind(path)
     os.umask(old_umask)
-    sock.listen(5)
+    sock.listen(socket.SOMAXCONN)
     return sock
 
 
+class IntermediateCache(object):
+    """Bounded LRU cache of intermediates keyed by master fingerprint.
+
+    Each entry expires lifetime seconds after it was added.
+    Intermediates are held in bytearrays which are zeroed on eviction.
+    An entry can also hold the master, which is the intermediate
+    for the old algorithm.
+    """
+    def __init__(self, size=INTERMEDIATE_CACHE_SIZE,
+                 lifetime=CREDENTIALS_LIFETIME, clock=time.time):
+        # Fingerprints are keyed by a secret which never leaves this process.
+        self._fingerprint_key = os.urandom(32)
+        # Map from fingerprint to (intermediate bytearray,
+        # master bytearray or None).
+        self._cache = ttlcache.TTLCache(size, lifetime, clock)
+
+    def fingerprint(self, master):
+        """Non-reversible fingerprint of a master to use as a key."""
+        return hmac.new(key=self._fingerprint_key, msg=master,
+                        digestmod=hashlib.sha256).digest()
+
+    def get(self, fingerprint, old=False):
+        """Get an intermediate as a string, or None if it is not cached.
+
+        Args:
+            old: Get the intermediate for the old algorithm.
+        """
+        self.expire()
+        entry = self._cache.get(fingerprint)
+        if entry is None:
+            return None
+        intermediate, master = entry
+        if old:
+            return str(master) if master is not None else None
+        return str(intermediate)
+
+    def put(self, fingerprint, intermediate, master=None):
+        """Cache an intermediate, evicting the least recently used if full.
+
+        Args:
+            master: Also cache the master for the old algorithm.
+        """
+        self._cache.put(fingerprint, (
+            bytearray(intermediate),
+            bytearray(master) if master is not None else None))
+
+    def expire(self):
+        """Evict all entries which have outlived their lifetime."""
+        if self._cache.expire():
+            logging.info("Expiring credentials.")
+
+    def clear(self):
+        """Evict all entries."""
+        self._cache.clear()
+
+    def __contains__(self, fingerprint):
+        self.expire()
+        return fingerprint in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies in power of two buckets of microseconds.
+
+    Not thread safe on its own.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # Bucket i counts latencies of less than 2**i microseconds.
+        self.buckets = []
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = int(seconds * 1e6).bit_length()
+        if bucket >= len(self.buckets):
+            self.buckets.extend([0] * (bucket + 1 - len(self.buckets)))
+        self.buckets[bucket] += 1
+
+    def percentile(self, p):
+        """Upper bound in microseconds of the bucket holding percentile p."""
+        rank = p * self.count
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return 2 ** bucket
+        return None
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_us": self.total / self.count * 1e6 if self.count else None,
+            "max_us": self.max * 1e6,
+            "p50_us": self.percentile(0.5),
+            "p99_us": self.percentile(0.99),
+            "buckets_us": {str(2 ** bucket): n
+                           for bucket, n in enumerate(self.buckets) if n},
+        }
+
+
+class AgentStats(object):
+    """Counters, gauges and latency histograms for the agent.
+
+    Cheap enough to always keep. Safe to use from many threads.
+    """
+    def __init__(self, clock=timeit.default_timer):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._started = clock()
+        self._counters = collections.Counter()
+        self._gauges = collections.Counter()
+        self._peaks = collections.Counter()
+        self._histograms = collections.defaultdict(LatencyHistogram)
+
+    def count(self, name, n=1):
+        """Add to a counter."""
+        with self._lock:
+            self._counters[name] += n
+
+    def adjust(self, name, delta):
+        """Add to a gauge, keeping track of its peak."""
+        with self._lock:
+            self._gauges[name] += delta
+            self._peaks[name] = max(self._peaks[name], self._gauges[name])
+
+    def record(self, name, seconds):
+        """Record a latency."""
+        with self._lock:
+            self._histograms[name].record(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Context manager which records how long its body takes."""
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.record(name, self._clock() - start)
+
+    def snapshot(self):
+        """Get all stats as a json serializable dict."""
+        with self._lock:
+            return {
+                "uptime_s": self._clock() - self._started,
+                "counters": dict(self._counters),
+                "gauges": {name: {"current": self._gauges[name],
+                                  "peak": self._peaks[name]}
+                           for name in self._gauges},
+                "latency": {name: histogram.snapshot()
+                            for name, histogram in self._histograms.iteritems()},
+            }
+
+
 class _Agent(object):
     def __init__(self):
         self.canceled = False
-        self.last_auth = time.time()
+        self.exit_code = 0
+        self.stats = AgentStats()
+        self.intermediates = IntermediateCache()
+        # Passwords made with the active master.
+        self.passwords = hashpasslib.PasswordCache()
+        # Fingerprint of the master in use.
+        self.active = None
+        # Guards intermediates, active and prompt.
+        self._lock = threading.Lock()
+        # Event set when the master prompt in flight finishes, or None.
+        self._prompt = None
 
         self._run()
 
     def _run(self):
         logging.info("Agent started.")
 
-        server_sock = make_server_socket(daemon_sock_path())
+        server_sock = make_server_socket(agent_protocol.daemon_sock_path())
         self.canceled = False
 
         while not self.canceled:
+            # Wake up every so often to notice a shutdown.
+            readable, _, _ = select.select([server_sock], [], [],
+                                           ACCEPT_POLL_INTERVAL)
+            if not readable:
+                continue
             sock, addr = server_sock.accept()
             logging.debug("Connection from '{}'".format(addr))
-            req = sock.recv(4096)
-            logging.debug("Received: {}".format(req))
-            try:
-                req = json.loads(req)
-            except ValueError as exc:
-                logging.debug("Received invalid json.")
-                continue
-            res = self.process_message(req)
-            if res == None:
-                sock.close()
-                continue
-            res = json.dumps(res)
+            # Serve each client on its own thread so a pinentry
+            # prompt does not hold up everyone else.
+            thread = threading.Thread(target=self._serve_connection,
+                                      args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+        server_sock.close()
+        logging.info("Shutting down by request.")
+        sys.exit(self.exit_code)
+
+    def _serve_connection(self, sock):
+        """Answer requests on a client connection until it is closed.
+
+        Requests with an "id" are answered on their own threads, at most
+        REQUESTS_PER_CONNECTION at once, others in the order they arrive.
+        """
+        send_lock = threading.Lock()
+        slots = threading.BoundedSemaphore(REQUESTS_PER_CONNECTION)
+        request_threads = []
+        self.stats.count("connections")
+        self.stats.adjust("open_connections", 1)
+        with contextlib.closing(sock):
             try:
-                sock.sendall(res)
+                reader = agent_protocol.LineReader(sock)
+                while True:
+                    line = reader.read_line()
+                    if line is None:
+                        break
+                    logging.debug("Received: {}".format(line))
+                    try:
+                        req = agent_protocol.decode_message(line)
+                    except agent_protocol.ProtocolException:
+                        logging.debug("Received invalid json.")
+                        continue
+                    if isinstance(req, dict) and "id" in req:
+                        slots.acquire()
+                        thread = threading.Thread(
+                            target=self._serve_request_in_slot,
+                            args=(sock, send_lock, req, slots))
+                        thread.daemon = True
+                        thread.start()
+                        request_threads = [t for t in request_threads
+                                           if t.is_alive()]
+                        request_threads.append(thread)
+                    else:
+                        self._serve_request(sock, send_lock, req)
             except socket.error as exc:
-                if (isinstance(exc.args, tuple) and
-                    exc.args[0] == errno.EPIPE):
-                    logging.warn("Client left before being sent response.")
+                if exc.errno in (errno.ECONNRESET, errno.EPIPE):
+                    # Like EOF, the client went away.
+                    logging.debug("Client closed the connection.")
                 else:
-                    raise
-            sock.close()
-
-        logging.info("Shutting down by request.")
-        sys.exit(0)
+                    logging.exception("Error serving connection.")
+            except Exception:
+                logging.exception("Error serving connection.")
+            # Let pending requests answer before closing.
+            for thread in request_threads:
+                thread.join()
+        self.stats.adjust("open_connections", -1)
+
+    def _serve_request_in_slot(self, sock, send_lock, req, slots):
+        """_serve_request, then give back the slot taken for it."""
+        try:
+            self._serve_request(sock, send_lock, req)
+        finally:
+            slots.release()
+
+    def _serve_request(self, sock, send_lock, req):
+        """Process a request and send the response or responses."""
+        mtype = req.get("type") if isinstance(req, dict) else None
+        if mtype not in MESSAGE_TYPES:
+            mtype = "invalid"
+        self.stats.count("messages." + mtype)
+        self.stats.adjust("requests_in_flight", 1)
+        start = timeit.default_timer()
+        try:
+            res = self.process_message(req)
+            if res == None:
+                res = {"error": "invalid message"}
+            responses = [res] if isinstance(res, dict) else res
+            for res in responses:
+                if not self._send_response(sock, send_lock, req, res):
+                    return
+        except Exception:
+            logging.exception("Error processing message.")
+            self.stats.count("errors")
+            self._send_response(sock, send_lock, req, {"error": "internal error"})
+        finally:
+            self.stats.record("request." + mtype, timeit.default_timer() - start)
+            self.stats.adjust("requests_in_flight", -1)
+
+    def _send_response(self, sock, send_lock, req, res):
+        """Send a response to req.
+
+        Returns: Whether it was sent.
+        """
+        if isinstance(req, dict) and "id" in req:
+            res["id"] = req["id"]
+        try:
+            with send_lock:
+                sock.sendall(agent_protocol.encode_message(res))
+        except socket.error as exc:
+            if exc.errno in (errno.EPIPE, errno.ECONNRESET):
+                logging.warn("Client left before being sent response.")
+            else:
+                logging.exception("Error sending response.")
+            return False
+        return True
 
     def process_message(self, message):
         """Process a json message.
 
         This does user interaction and could block for a long time.
+        Safe to call from many threads at once.
 
-        Returns: Response to return to client.
+        Returns: Response to return to client. Or for streamed replies,
+            an iterator of responses which all but the last mark with "more".
         """
         if not isinstance(message, dict):
             return None
@@ -167,20 +435,35 @@ class _Agent(object):
         if mtype == "ping":
             return {"pong": "pong"}
         if mtype == "get_password":
-            slug = message.get("slug", None)
+            slug = _slug_bytes(message.get("slug", None))
             if slug == None:
                 return None
+            old = bool(message.get("old", False))
 
-            # Try once to get a master.
-            if not hashpasslib.is_ready():
-                get_master_gui(use_bcrypt=True)
-                if hashpasslib.is_ready():
-                    self.last_auth = time.time()
-            if hashpasslib.is_ready():
-                password = hashpasslib.make_password(slug, old=False)
-                return {"password": password}
+            password = self.passwords.get_or_make(slug, old, self._make_password)
+            if password is not None:
+                return {"password": password, "old": old}
             else:
                 return {"error": "no master"}
+        if mtype == "get_passwords":
+            slugs = message.get("slugs", None)
+            if not isinstance(slugs, list):
+                return None
+            slugs = map(_slug_bytes, slugs)
+            if None in slugs:
+                return None
+            olds = message.get("old", False)
+            if not isinstance(olds, list):
+                olds = [olds] * len(slugs)
+            if len(olds) != len(slugs):
+                return None
+            return self._stream_passwords(slugs, map(bool, olds))
+        if mtype == "stats":
+            stats = self.stats.snapshot()
+            with self._lock:
+                stats["intermediate_cache_size"] = len(self.intermediates)
+            stats["password_cache"] = self.passwords.stats()
+            return {"stats": stats}
         if mtype == "shutdown":
             self.canceled = True
             return {"ok": "ok"}
@@ -188,47 +471,167 @@ class _Agent(object):
         # Unrecognized message type.
         return None
 
+    def _make_password(self, slug, old):
+        """Make a password with the active master, asking for it once if needed.
+
+        Returns: The password or None if there is no master.
+        """
+        intermediate = self.get_intermediate(old)
+        if intermediate is None:
+            return None
+        with self.stats.timed("derive_password"):
+            return alg.make_site_password(intermediate, slug, old=old)
+
+    def _stream_passwords(self, slugs, olds):
+        """Generate a response with the password of each slug.
+
+        Passwords are derived a chunk at a time, in order.
+        The last response says how many passwords were sent.
+        """
+        intermediates = {}
+        for old in set(olds):
+            intermediates[old] = self.get_intermediate(old)
+            if intermediates[old] is None:
+                yield {"error": "no master"}
+                return
+
+        for start in xrange(0, len(slugs), PASSWORDS_CHUNK_SIZE):
+            indices = range(start, min(start + PASSWORDS_CHUNK_SIZE, len(slugs)))
+            passwords = {}
+            with self.stats.timed("derive_passwords_chunk"):
+                for old, intermediate in intermediates.iteritems():
+                    group = [i for i in indices if olds[i] == old]
+                    derived = alg.make_site_passwords(
+                        intermediate, [slugs[i] for i in group], old=old)
+                    passwords.update(zip(group, derived))
+            for i in indices:
+                yield {"index": i, "password": passwords[i], "more": True}
+        yield {"count": len(slugs)}
+
+    def get_intermediate(self, old=False):
+        """Get the intermediate for the active master.
+
+        Asks for the master if there is none. If another thread is
+        already asking, waits for its answer instead of asking again.
+
+        Args:
+            old: Get the intermediate for the old algorithm.
+
+        Returns: The intermediate or None if the user canceled.
+        """
+        with self._lock:
+            intermediate = self._active_intermediate(old)
+            if intermediate is not None:
+                self.stats.count("intermediate_cache.hit")
+                return intermediate
+            self.stats.count("intermediate_cache.miss")
+            prompt = self._prompt
+            asking = prompt is None
+            if asking:
+                prompt = self._prompt = threading.Event()
+
+        start = timeit.default_timer()
+        if asking:
+            try:
+                self._ask_for_master()
+            finally:
+                with self._lock:
+                    self._prompt = None
+                prompt.set()
+        else:
+            prompt.wait()
+        self.stats.record("master_wait", timeit.default_timer() - start)
+
+        with self._lock:
+            return self._active_intermediate(old)
+
+    def _active_intermediate(self, old):
+        """Get the cached intermediate of the active master or None.
+
+        Call with the lock held.
+        """
+        if self.active is None:
+            return None
+        return self.intermediates.get(self.active, old)
+
+    def _ask_for_master(self):
+        """Ask for the master and make it active if it is correct."""
+        try:
+            with self.stats.timed("pinentry"):
+                master = get_master_gui()
+        except pinentry.PinEntryException:
+            logging.critical("Cannot use pinentry.")
+            self.exit_code = -1
+            self.canceled = True
+            return
+        if master is None:
+            return
+
+        with self._lock:
+            fingerprint = self.intermediates.fingerprint(master)
+            cached = fingerprint in self.intermediates
+        if not cached:
+            # Slow, so do it without the lock.
+            with self.stats.timed("derive_intermediate"):
+                intermediate = alg.make_intermediate(master)
+        with self._lock:
+            if not cached:
+                self.intermediates.put(fingerprint, intermediate, master)
+            if self.active not in (None, fingerprint):
+                # Without an active master the cache is empty already.
+                self.passwords.clear()
+            self.active = fingerprint
+
     def maybe_expire_credentials(self):
-        """Expire credentials if it has been too long."""
-        time_since_last_auth = time.time() - self.last_auth
-        logging.debug("Time since last auth {}.".format(time_since_last_auth))
-        if time_since_last_auth > CREDENTIALS_LIFETIME:
-            logging.info("Expiring credentials.")
-            hashpasslib.forget_master()
+        """Expire each cached intermediate once it has been too long."""
+        with self._lock:
+            self.intermediates.expire()
+            if self.active is not None and self.active not in self.intermediates:
+                self.active = None
+                self.passwords.clear()
+
 
+def _slug_bytes(slug):
+    """Encode a slug from a message like the command line would.
 
-def get_master_gui(use_bcrypt):
+    Returns: The slug as a utf-8 string, or None if it is not a string.
+    """
+    if isinstance(slug, unicode):
+        return slug.encode("utf-8")
+    if isinstance(slug, str):
+        return slug
+    return None
+
+
+def get_master_gui():
     """Gets the password via pinentry.
 
-    Calls use_master if it works, otherwise does nothing.
+    Returns: The master if it matches the stored one, otherwise None.
 
-    Returns: None
+    Raises:
+        PinEntryException if pinentry can not be used.
     """
-    try:
-        pw = pinentry.get_pin(description="Enter hashpass master password:",
-                              prompt="Password:")
-        while pw is None or not hashpasslib.is_correct_master(pw):
-            if pw == None:
-                logging.warn("User canceled password entry.")
-                return None
-            pw = pinentry.get_pin(description="Enter hashpass master password:",
-                                  prompt="Password:",
-                                  errormsg="That doesn't match the stored master.")
-        hashpasslib.use_master(pw, use_bcrypt)
-    except pinentry.PinEntryException:
-        logging.critical("Cannot use pinentry.")
-        sys.exit(-1)
-        return None
+    pw = pinentry.get_pin_until(hashpasslib.is_correct_master,
+                                description="Enter hashpass master password:",
+                                prompt="Password:",
+                                errormsg="That doesn't match the stored master.")
+    if pw is None:
+        logging.warn("User canceled password entry.")
+    return pw
 
 
-if __name__ == "__main__":
+def main():
+    # Set up logging.
+    logging.basicConfig(filename="./agent.log", level=logging.DEBUG, disabled=True)
+    logging.getLogger().disabled = True
+
     print "Starting daemon."
     logging.info("Started launcher.")
     logging.debug("Creating daemon dir.")
     create_daemon_dir()
 
     # A inter-process lock to ensure only one agent runs per user.
-    process_lock = fasteners.InterProcessLock(daemon_lock_path())
+    process_lock = fasteners.InterProcessLock(agent_protocol.daemon_lock_path())
 
     # Disable initgroups because it requires root.
     with daemon.DaemonContext(
@@ -244,3 +647,7 @@ if __name__ == "__main__":
             sys.exit(-1)
 
     logging.info("Shutting down.")
+
+
+if __name__ == "__main__":
+    main()
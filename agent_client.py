@@ -1,93 +1,516 @@
 """
 Client for communicating with the agent.
+
+A Session keeps one connection to the agent open and sends all of its
+requests over it. The functions here use one Session for the whole process.
 """
-import sys
-import os
-import json
+import itertools
+import select
 import socket
-import traceback
-import contextlib
-import agent
-import logging
+import threading
+import time
+import agent_protocol
+
 
+# Seconds to wait for the agent to respond.
+RECEIVE_TIMEOUT = 30
 
-# Set up logging.
-logging.getLogger().disabled = True
+# Most connections a ConnectionPool opens at once.
+POOL_SIZE = 4
+# Seconds a pooled connection can be idle before it is checked on reuse.
+POOL_IDLE_CHECK = 1
 
 
 class AgentClientException(Exception):
     pass
 
 
+class _ConnectionLost(AgentClientException):
+    """The connection broke and the request may be retried on a new one."""
+
+
 def is_alive():
     """Whether the agent is alive."""
-    try:
-        return ping() is not None
-    except AgentClientException:
-        return False
+    return _session.is_alive()
 
 
 def ping():
-    return _send_object({"type": "ping"})
+    return _session.ping()
 
 
-def get_password(slug):
+def get_password(slug, old=False):
     """
     Ask the agent to make a password.
 
     Returns: password or None
     """
-    res = _send_object({
-        "type": "get_password",
-        "slug": slug,
-    })
-    if "password" in res:
-        return str(res["password"])
-    else:
-        return None
+    return _session.get_password(slug, old=old)
+
+
+def get_passwords(slugs, old=False):
+    """
+    Ask the agent to make many passwords.
+
+    See Session.get_passwords.
+    """
+    return _session.get_passwords(slugs, old=old)
+
+
+def get_stats():
+    """Get the agent's stats as a dict."""
+    return _session.get_stats()
 
 
 def send_shutdown():
-    _send_object({"type": "shutdown"})
+    _session.send_shutdown()
+
+
+class Session(object):
+    """Talks to the agent over one connection.
+
+    Connects on first use, and reconnects once if the connection has gone
+    away, for example because the agent restarted. Whether the agent is
+    alive is only found out once: after a failed connect every request
+    fails straight away. Safe to share between threads.
+
+    Args:
+        path: Socket to connect to. Defaults to the agent's socket.
+    """
+    def __init__(self, path=None):
+        self._path = path
+        # Guards the fields below.
+        self._lock = threading.Lock()
+        self._connection = None
+        # Whether the agent is alive, or None if not known yet.
+        self._alive = None
+
+    def is_alive(self):
+        """Whether the agent is alive, only asking it the first time."""
+        if self._alive is None:
+            try:
+                self.ping()
+            except AgentClientException:
+                self._alive = False
+        return self._alive
+
+    def ping(self):
+        return self._send_object({"type": "ping"})
+
+    def get_password(self, slug, old=False):
+        """
+        Ask the agent to make a password.
+
+        Returns: password or None
+        """
+        res = self._send_object({
+            "type": "get_password",
+            "slug": slug,
+            "old": old,
+        })
+        # Agents which predate old ignore it and use the new algorithm.
+        if "password" in res and res.get("old", False) != old:
+            raise AgentClientException("Agent does not support old.")
+        if "password" in res:
+            return str(res["password"])
+        else:
+            return None
+
+    def get_passwords(self, slugs, old=False):
+        """
+        Ask the agent to make many passwords.
+
+        Args:
+            slugs: A list of slugs.
+            old: Whether to use the old algorithm. Either one bool for all
+                slugs or a list of one bool per slug.
+
+        Returns: A list of passwords in the same order as slugs, or None
+            if there is no master.
+
+        Raises:
+            AgentClientException, also if the agent does not support it.
+        """
+        passwords = [None] * len(slugs)
+        for res in self._stream_object({
+                "type": "get_passwords",
+                "slugs": slugs,
+                "old": old,
+                }):
+            if "password" in res:
+                passwords[res["index"]] = str(res["password"])
+        if res.get("error") == "no master":
+            return None
+        if "error" in res:
+            raise AgentClientException("Agent error.", res["error"])
+        if None in passwords:
+            raise AgentClientException("Missing passwords.")
+        return passwords
+
+    def get_stats(self):
+        """Get the agent's stats as a dict."""
+        res = self._send_object({"type": "stats"})
+        if "stats" not in res:
+            raise AgentClientException("Agent does not support stats.")
+        return res["stats"]
+
+    def send_shutdown(self):
+        self._send_object({"type": "shutdown"})
+
+    def close(self):
+        """Close the connection. The next request connects again."""
+        with self._lock:
+            connection, self._connection = self._connection, None
+            self._alive = None
+        if connection is not None:
+            connection.close()
+
+    def _get_connection(self):
+        """Get the connection, connecting if there is none.
+
+        Returns: A tuple of (connection, whether it was just made).
+        """
+        with self._lock:
+            if self._connection is not None:
+                return self._connection, False
+            if self._alive is False:
+                raise AgentClientException("Agent is not running.")
+            try:
+                self._connection = _Connection(
+                    self._path or agent_protocol.daemon_sock_path())
+            except AgentClientException:
+                self._alive = False
+                raise
+            self._alive = True
+            return self._connection, True
+
+    def _drop_connection(self, connection):
+        """Close a connection and stop using it."""
+        with self._lock:
+            if self._connection is connection:
+                self._connection = None
+        connection.close()
+
+    def _release_connection(self, connection):
+        """Done with a connection from _get_connection for now."""
+
+    def _send_objects(self, messages):
+        """Send messages to the agent and receive their responses.
+
+        Reuses the connection. If it has gone away, reconnects once.
+        """
+        for attempt in (0, 1):
+            connection, new = self._get_connection()
+            try:
+                return connection.send_objects(messages)
+            except _ConnectionLost:
+                self._drop_connection(connection)
+                connection = None
+                if new or attempt:
+                    raise
+            finally:
+                if connection is not None:
+                    self._release_connection(connection)
+
+    def _stream_object(self, message):
+        """Send a message to the agent and generate its responses.
+
+        Like _send_objects, reconnects once if the connection has gone away
+        before any response arrived.
+        """
+        for attempt in (0, 1):
+            connection, new = self._get_connection()
+            received = False
+            try:
+                for res in connection.stream_object(message):
+                    received = True
+                    yield res
+                return
+            except _ConnectionLost:
+                self._drop_connection(connection)
+                connection = None
+                if new or received or attempt:
+                    raise
+            finally:
+                if connection is not None:
+                    self._release_connection(connection)
 
+    def _send_object(self, message):
+        """Send and receive an object as json."""
+        return self._send_objects([message])[0]
 
-def _send_string(message):
-    """Send and receive a string."""
-    with contextlib.closing(socket.socket(
-            socket.AF_UNIX,
-            socket.SOCK_STREAM)) as sock:
+
+class ConnectionPool(Session):
+    """Talks to the agent over a bounded pool of connections.
+
+    Each request has a connection to itself, and threads wait for one
+    to come free once size connections are open. Idle connections are
+    checked before reuse, and dead ones are evicted, for example after
+    the agent restarted. Unlike Session, every request tries to connect
+    again. Safe to share between threads.
+
+    Args:
+        size: Most connections to have open at once.
+        path: Socket to connect to. Defaults to the agent's socket.
+        idle_check: Check connections idle for at least this many seconds.
+        wait_timeout: Seconds to wait for a free connection.
+    """
+    def __init__(self, size=POOL_SIZE, path=None, idle_check=POOL_IDLE_CHECK,
+                 wait_timeout=RECEIVE_TIMEOUT, clock=time.time):
+        super(ConnectionPool, self).__init__(path)
+        self.size = size
+        self.idle_check = idle_check
+        self.wait_timeout = wait_timeout
+        self._clock = clock
+        # Guards the fields below and is notified when a connection frees up.
+        self._available = threading.Condition()
+        # (connection, idle since), most recently used last.
+        self._idle = []
+        # Connections open or being opened.
+        self._open = 0
+        self._counts = dict.fromkeys(
+            ["created", "reused", "evicted", "health_checks", "waits"], 0)
+
+    def is_alive(self):
+        """Whether the agent is alive."""
+        try:
+            return self.ping() is not None
+        except AgentClientException:
+            return False
+
+    def stats(self):
+        """Returns: A dict of pool sizes and counts of what it has done."""
+        with self._available:
+            stats = dict(self._counts)
+            stats.update(size=self.size, open=self._open, idle=len(self._idle),
+                         in_use=self._open - len(self._idle))
+            return stats
+
+    def close(self):
+        """Close the idle connections."""
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._available.notify_all()
+        for connection, _ in idle:
+            connection.close()
+
+    def _get_connection(self):
+        deadline = self._clock() + self.wait_timeout
+        with self._available:
+            while True:
+                while self._idle:
+                    connection, since = self._idle.pop()
+                    if self._clock() - since >= self.idle_check:
+                        self._counts["health_checks"] += 1
+                        if connection.is_closed():
+                            self._evict(connection)
+                            continue
+                    self._counts["reused"] += 1
+                    return connection, False
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                remaining = deadline - self._clock()
+                if remaining <= 0:
+                    raise AgentClientException("No connection came free.")
+                self._counts["waits"] += 1
+                self._available.wait(remaining)
+        try:
+            connection = _Connection(self._path or agent_protocol.daemon_sock_path())
+        except AgentClientException:
+            with self._available:
+                self._open -= 1
+                self._available.notify()
+            raise
+        with self._available:
+            self._counts["created"] += 1
+        return connection, True
+
+    def _release_connection(self, connection):
+        with self._available:
+            self._idle.append((connection, self._clock()))
+            self._available.notify()
+
+    def _drop_connection(self, connection):
+        with self._available:
+            self._evict(connection)
+            # The agent probably went away, so the idle ones are dead too.
+            alive = []
+            for idle in self._idle:
+                if idle[0].is_closed():
+                    self._evict(idle[0])
+                else:
+                    alive.append(idle)
+            self._idle = alive
+            self._available.notify_all()
+
+    def _evict(self, connection):
+        """Close a connection which is not idle anymore. Call with the lock held."""
+        connection.close()
+        self._open -= 1
+        self._counts["evicted"] += 1
+
+
+class _Connection(object):
+    """A connection to the agent which can carry many requests.
+
+    Safe to share between threads. Whichever thread is waiting reads
+    the next response and hands it to the thread that sent the request.
+    """
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            sock.connect(agent.daemon_sock_path())
+            self._sock.connect(path)
         except socket.error as exc:
+            self._sock.close()
             raise AgentClientException("Could not connect.", exc)
+        self._sock.settimeout(RECEIVE_TIMEOUT)
+        self._reader = agent_protocol.LineReader(self._sock)
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        # Guards the fields below.
+        self._received = threading.Condition()
+        # Map from request id to list of responses not yet waited for.
+        self._responses = {}
+        # Ids of requests nobody waits for anymore, until their last response.
+        self._abandoned = set()
+        # Whether a thread is reading from the socket.
+        self._receiving = False
 
-        sock.settimeout(30)
+    def send_objects(self, messages):
+        """Send messages and receive their responses.
 
+        All messages are sent before reading any response.
+
+        Returns: The responses in the same order as messages.
+        """
+        ids = self._send(messages)
+        responses = []
+        try:
+            for request_id in ids:
+                responses.append(self._wait_for(request_id))
+        except AgentClientException:
+            self._abandon(ids[len(responses):])
+            raise
+        return responses
+
+    def stream_object(self, message):
+        """Send a message and generate each of its responses."""
+        request_id, = self._send([message])
+        done = False
         try:
-            sock.sendall(message)
+            while not done:
+                res = self._wait_for(request_id)
+                done = not res.pop("more", False)
+                yield res
+        finally:
+            if not done:
+                self._abandon([request_id])
+
+    def close(self):
+        self._sock.close()
+
+    def is_closed(self):
+        """Whether the agent closed the connection, without blocking.
+
+        Only call while no request is in flight. Unexpected data also
+        counts as closed, since the connection is out of step.
+        """
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+        except (select.error, ValueError):
+            return True
+        return bool(readable)
+
+    def _send(self, messages):
+        """Send messages with new request ids.
+
+        Returns: The request ids.
+        """
+        ids = []
+        lines = []
+        for message in messages:
+            request_id = next(self._ids)
+            ids.append(request_id)
+            lines.append(agent_protocol.encode_message(
+                dict(message, id=request_id)))
+
+        try:
+            with self._send_lock:
+                self._sock.sendall(b"".join(lines))
         except socket.error as exc:
-            raise AgentClientException("Send failed.", exc)
+            raise _ConnectionLost("Send failed.", exc)
+        return ids
+
+    def _abandon(self, ids):
+        """Drop the responses to requests nobody waits for anymore."""
+        with self._received:
+            for request_id in ids:
+                responses = self._responses.pop(request_id, [])
+                if not responses or responses[-1].get("more", False):
+                    self._abandoned.add(request_id)
+
+    def _wait_for(self, request_id):
+        """Wait for the next response to a request."""
+        with self._received:
+            while not self._responses.get(request_id):
+                if self._receiving:
+                    self._received.wait()
+                    continue
+                self._receiving = True
+                self._received.release()
+                try:
+                    res = self._receive_object()
+                finally:
+                    self._received.acquire()
+                    self._receiving = False
+                    self._received.notify_all()
+                # Agents from before request ids answer one request
+                # per connection.
+                res_id = res.pop("id", request_id)
+                if res_id in self._abandoned:
+                    if not res.get("more", False):
+                        self._abandoned.discard(res_id)
+                else:
+                    self._responses.setdefault(res_id, []).append(res)
+            responses = self._responses[request_id]
+            res = responses.pop(0)
+            if not responses:
+                del self._responses[request_id]
+            return res
 
+    def _receive_object(self):
         try:
-            res = sock.recv(4096)
+            line = self._reader.read_line()
         except socket.timeout as exc:
             raise AgentClientException("Receive timed out.", exc)
         except socket.error as exc:
+            raise _ConnectionLost("Receive failed.", exc)
+        except agent_protocol.ProtocolException as exc:
             raise AgentClientException("Receive failed.", exc)
-
+        if line is None:
+            raise _ConnectionLost("Connection closed by agent.")
+        try:
+            res = agent_protocol.decode_message(line)
+        except agent_protocol.ProtocolException as exc:
+            raise AgentClientException(*exc.args)
+        if not isinstance(res, dict):
+            raise AgentClientException("Received invalid response.", res)
         return res
 
 
-def _send_object(message):
-    """Send and receive and object as json."""
-    res = _send_string(json.dumps(message))
-    try:
-        res = json.loads(res)
-    except ValueError as exc:
-        raise AgentClientException(
-            "Received invalid json.", res, exc)
-    return res
+# The session used by this process.
+_session = Session()
+
+
+def __getattr__(name):
+    # Python 3.7 and later look up missing module attributes here, so the
+    # asyncio client is only imported by those who use it.
+    if name == "AsyncAgentClient":
+        from agent_client_async import AsyncAgentClient
+        return AsyncAgentClient
+    raise AttributeError(name)
 
 
 if __name__ == "__main__":
-    print ping()
+    print(ping())
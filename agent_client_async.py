@@ -0,0 +1,276 @@
+"""
+asyncio client for the agent, for Python 3.7 and later.
+
+Use it as agent_client.AsyncAgentClient. Like agent_client.Session it
+sends every request over one connection, and since requests carry ids
+any number of them can be in flight at once.
+"""
+import asyncio
+import itertools
+
+import agent_client
+import agent_protocol
+from agent_client import AgentClientException, _ConnectionLost
+
+
+class AsyncAgentClient(object):
+    """Talks to the agent from asyncio over one connection.
+
+    Connects on first use, and reconnects once if the connection has gone
+    away, for example because the agent restarted. Each request waits at
+    most timeout seconds for each of its responses. Cancelling a request
+    only stops waiting for its answer, other requests carry on. Errors are
+    raised as AgentClientException, like the synchronous client.
+
+    Args:
+        path: Socket to connect to. Defaults to the agent's socket.
+        timeout: Default seconds to wait for a response.
+    """
+    def __init__(self, path=None, timeout=agent_client.RECEIVE_TIMEOUT):
+        self._path = path
+        self.timeout = timeout
+        self._ids = itertools.count()
+        self._connection = None
+        # Made on first use, so it belongs to the running loop.
+        self._connect_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def ping(self, timeout=None):
+        return await self._send_object({"type": "ping"}, timeout)
+
+    async def get_password(self, slug, old=False, timeout=None):
+        """
+        Ask the agent to make a password.
+
+        Returns: password or None
+        """
+        res = await self._send_object({
+            "type": "get_password",
+            "slug": slug,
+            "old": old,
+        }, timeout)
+        # Agents which predate old ignore it and use the new algorithm.
+        if "password" in res and res.get("old", False) != old:
+            raise AgentClientException("Agent does not support old.")
+        if "password" in res:
+            return str(res["password"])
+        else:
+            return None
+
+    async def get_passwords(self, slugs, old=False, timeout=None):
+        """
+        Ask the agent to make many passwords.
+
+        Args:
+            slugs: A list of slugs.
+            old: Whether to use the old algorithm. Either one bool for all
+                slugs or a list of one bool per slug.
+            timeout: Seconds to wait for each response.
+
+        Returns: A list of passwords in the same order as slugs, or None
+            if there is no master.
+
+        Raises:
+            AgentClientException, also if the agent does not support it.
+        """
+        passwords = [None] * len(slugs)
+        res = {}
+        async for res in self._stream_object({
+                "type": "get_passwords",
+                "slugs": slugs,
+                "old": old,
+                }, timeout):
+            if "password" in res:
+                passwords[res["index"]] = str(res["password"])
+        if res.get("error") == "no master":
+            return None
+        if "error" in res:
+            raise AgentClientException("Agent error.", res["error"])
+        if None in passwords:
+            raise AgentClientException("Missing passwords.")
+        return passwords
+
+    async def get_stats(self, timeout=None):
+        """Get the agent's stats as a dict."""
+        res = await self._send_object({"type": "stats"}, timeout)
+        if "stats" not in res:
+            raise AgentClientException("Agent does not support stats.")
+        return res["stats"]
+
+    async def send_shutdown(self, timeout=None):
+        await self._send_object({"type": "shutdown"}, timeout)
+
+    async def close(self):
+        """Close the connection. The next request connects again."""
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            await connection.close()
+
+    async def _get_connection(self):
+        """Get the connection, connecting if there is none.
+
+        Returns: A tuple of (connection, whether it was just made).
+        """
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._connection is not None:
+                if self._connection.error is None:
+                    return self._connection, False
+                await self._drop_connection(self._connection)
+            self._connection = await _AsyncConnection.open(
+                self._path or agent_protocol.daemon_sock_path())
+            return self._connection, True
+
+    async def _drop_connection(self, connection):
+        """Close a connection and stop using it."""
+        if self._connection is connection:
+            self._connection = None
+        await connection.close()
+
+    async def _stream_object(self, message, timeout):
+        """Send a message to the agent and generate its responses.
+
+        Reconnects once if the connection has gone away before any
+        response arrived.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        connection, new = await self._get_connection()
+        received = False
+        try:
+            async for res in connection.stream(message, next(self._ids), timeout):
+                received = True
+                yield res
+            return
+        except _ConnectionLost:
+            await self._drop_connection(connection)
+            if new or received:
+                raise
+        connection, _ = await self._get_connection()
+        try:
+            async for res in connection.stream(message, next(self._ids), timeout):
+                yield res
+        except _ConnectionLost:
+            await self._drop_connection(connection)
+            raise
+
+    async def _send_object(self, message, timeout):
+        """Send a message and receive its response."""
+        res = None
+        async for res in self._stream_object(message, timeout):
+            pass
+        return res
+
+
+class _AsyncConnection(object):
+    """A connection to the agent which can carry many requests.
+
+    A task reads every response and hands it to the request with its id.
+    """
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._send_lock = asyncio.Lock()
+        # Map from request id to a queue of its responses.
+        self._queues = {}
+        # The exception which ended the connection, or None while it is up.
+        self.error = None
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    @classmethod
+    async def open(cls, path):
+        try:
+            reader, writer = await asyncio.open_unix_connection(
+                path, limit=agent_protocol.MAX_LINE_LENGTH)
+        except OSError as exc:
+            raise AgentClientException("Could not connect.", exc)
+        return cls(reader, writer)
+
+    async def stream(self, message, request_id, timeout):
+        """Send a message and generate each of its responses."""
+        queue = asyncio.Queue()
+        self._queues[request_id] = queue
+        try:
+            await self._send(dict(message, id=request_id))
+            while True:
+                try:
+                    res = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError as exc:
+                    raise AgentClientException("Receive timed out.", exc)
+                if isinstance(res, Exception):
+                    raise res
+                more = res.pop("more", False)
+                yield res
+                if not more:
+                    return
+        finally:
+            self._queues.pop(request_id, None)
+
+    async def close(self):
+        self._receiver.cancel()
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+
+    async def _send(self, message):
+        if self.error is not None:
+            raise self.error
+        try:
+            async with self._send_lock:
+                self._writer.write(agent_protocol.encode_message(message))
+                await self._writer.drain()
+        except OSError as exc:
+            raise _ConnectionLost("Send failed.", exc)
+
+    async def _receive(self):
+        """Read responses until the connection breaks."""
+        try:
+            while True:
+                self._dispatch(await self._receive_object())
+        except AgentClientException as exc:
+            self._fail(exc)
+        except asyncio.CancelledError:
+            self._fail(_ConnectionLost("Connection closed."))
+            raise
+
+    def _dispatch(self, res):
+        request_id = res.pop("id", None)
+        if request_id is None and len(self._queues) == 1:
+            # Agents from before request ids answer one request
+            # per connection.
+            request_id = next(iter(self._queues))
+        queue = self._queues.get(request_id)
+        # Nobody waits for the responses of canceled requests.
+        if queue is not None:
+            queue.put_nowait(res)
+
+    def _fail(self, exc):
+        self.error = exc
+        for queue in self._queues.values():
+            queue.put_nowait(exc)
+
+    async def _receive_object(self):
+        try:
+            line = await self._reader.readline()
+        except ValueError as exc:
+            # Longer than MAX_LINE_LENGTH.
+            raise AgentClientException("Receive failed.", exc)
+        except OSError as exc:
+            raise _ConnectionLost("Receive failed.", exc)
+        if not line:
+            raise _ConnectionLost("Connection closed by agent.")
+        try:
+            res = agent_protocol.decode_message(line)
+        except agent_protocol.ProtocolException as exc:
+            raise AgentClientException(*exc.args)
+        if not isinstance(res, dict):
+            raise AgentClientException("Received invalid response.", res)
+        return res
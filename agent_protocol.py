@@ -0,0 +1,86 @@
+"""
+Wire protocol between the agent and its clients.
+
+Messages are JSON objects, one per line. A request may carry an "id"
+which the agent copies onto its response, so many requests can be in
+flight on one connection and replies can be matched up in any order.
+"""
+import json
+import os
+import os.path
+
+
+# Longest line to accept, so a bad peer can't use up all memory.
+MAX_LINE_LENGTH = 1024 * 1024
+
+
+class ProtocolException(Exception):
+    pass
+
+
+def daemon_dir_path():
+    return os.path.abspath("/tmp/hashpass-{}.d".format(os.getuid()))
+
+
+def daemon_lock_path():
+    return os.path.join(daemon_dir_path(), "agent.lock")
+
+
+def daemon_sock_path():
+    return os.path.join(daemon_dir_path(), "agent.sock")
+
+
+def encode_message(message):
+    """Encode a message as one line of bytes."""
+    line = json.dumps(message) + "\n"
+    if not isinstance(line, bytes):
+        # Python 3.
+        line = line.encode("utf-8")
+    return line
+
+
+def decode_message(line):
+    """Decode one line into a message.
+
+    Raises:
+        ProtocolException if the line is not valid json.
+    """
+    try:
+        return json.loads(line)
+    except ValueError as exc:
+        raise ProtocolException("Received invalid json.", line, exc)
+
+
+class LineReader(object):
+    """Reads newline terminated lines from a socket."""
+    def __init__(self, sock):
+        self._sock = sock
+        # Received data not yet returned as a line.
+        self._chunks = []
+        self._buffered = 0
+
+    def read_line(self):
+        """Read the next line, without its newline.
+
+        Blocks until a whole line arrives. If the peer closes the connection
+        after an unterminated line, that line is returned.
+
+        Returns: The line or None if the connection is closed.
+        """
+        while True:
+            if self._chunks and b"\n" in self._chunks[-1]:
+                data = b"".join(self._chunks)
+                line, rest = data.split(b"\n", 1)
+                self._chunks = [rest] if rest else []
+                self._buffered = len(rest)
+                return line
+            if self._buffered > MAX_LINE_LENGTH:
+                raise ProtocolException("Line too long.")
+            data = self._sock.recv(4096)
+            if not data:
+                line = b"".join(self._chunks)
+                self._chunks = []
+                self._buffered = 0
+                return line or None
+            self._chunks.append(data)
+            self._buffered += len(data)
@@ -5,9 +5,14 @@ This module contains functions used to generate passwords.
 Everything here is stateless.
 """
 
+import base64
 import bcrypt
+import collections
 import hashlib
 import hmac
+import itertools
+import multiprocessing
+import string
 
 
 # Salt for generating intermediate. (10 rounds)
@@ -17,10 +22,53 @@ import hmac
 REUSED_BCRYPT_SALT = "$2y$10$w1dpoPu1duVEV4rnZPAkLe"
 # Rounds to use for storage.
 STORE_BCRYPT_ROUNDS = 13
+# Bcrypt ignores input after this many bytes.
+BCRYPT_MAX_LENGTH = 72
+
+# Maximum candidates to try for a site password.
+REROLL_LIMIT = 10000
+
+# Slugs per task and tasks in flight per process in iter_site_passwords.
+SITE_PASSWORDS_CHUNK_SIZE = 256
+_CHUNKS_IN_FLIGHT = 2
 
 LETTERS = "abcdefghjkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXY"
 NUMBERS = "3456789"
 SYMBOLS = "#*@()+={}?"
+CHARSET = LETTERS + NUMBERS + SYMBOLS
+
+# Base64 splits bytes into the same 6-bit groups as _bytes_to_pw_chars,
+# so translating its alphabet to CHARSET encodes a candidate in one pass.
+_B64_ALPHABET = string.ascii_uppercase + string.ascii_lowercase + string.digits + "+/"
+_B64_TO_CHARSET = string.maketrans(_B64_ALPHABET, CHARSET)
+
+# Character class bits, is_good_pass needs all of them.
+_LETTER = 1
+_NUMBER = 2
+_SYMBOL = 4
+_ALL_CLASSES = _LETTER | _NUMBER | _SYMBOL
+
+def _make_class_tables():
+    """Build the class lookup tables used by is_good_pass and friends.
+
+    Returns:
+        A tuple of (classes by charset index,
+                    classes by ord of charset character,
+                    classes by ord of base64 character).
+    """
+    by_index = ([_LETTER] * len(LETTERS) + [_NUMBER] * len(NUMBERS)
+                + [_SYMBOL] * len(SYMBOLS))
+    by_char = [0] * 256
+    by_b64 = [0] * 256
+    for i, cls in enumerate(by_index):
+        by_char[ord(CHARSET[i])] = cls
+        by_b64[ord(_B64_ALPHABET[i])] = cls
+    return by_index, by_char, by_b64
+
+_INDEX_CLASSES, _CHAR_CLASSES, _B64_CLASSES = _make_class_tables()
+
+# Debug mode. Check the fast paths against the reference implementations.
+CHECK_ASSERTS = False
 
 
 def make_intermediate(secret_master):
@@ -37,6 +85,37 @@ def make_intermediate(secret_master):
     _check_bcrypt_input(secret_master)
     return bcrypt.hashpw(secret_master, REUSED_BCRYPT_SALT)
 
+def make_intermediates(secret_masters, workers=None, return_exceptions=False):
+    """Generate intermediates for many masters in parallel.
+
+    Runs make_intermediate in a pool of processes,
+    since bcrypt does not release the GIL in every build.
+
+    Args:
+        secret_masters: A list of masters.
+        workers: Number of processes. Defaults to the number of CPUs.
+        return_exceptions: Put the exception for a master which can not be
+            used in its place in the results instead of raising it.
+
+    Returns:
+        A list of intermediates in the same order as secret_masters.
+    """
+    if workers == 1 or len(secret_masters) <= 1:
+        results = map(_make_intermediate_or_exception, secret_masters)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_make_intermediate_or_exception,
+                               secret_masters, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
+
 def make_site_password(secret_intermediate, slug, old):
     """Generate a site password from the secret_intermediate and site name.
 
@@ -55,6 +134,66 @@ def make_site_password(secret_intermediate, slug, old):
     else:
         return make_site_password_new(secret_intermediate, slug)
 
+def make_site_passwords(secret_intermediate, slugs, old=False):
+    """Generate site passwords for many slugs with one secret_intermediate.
+
+    Same results as calling make_site_password for each slug, but the
+    keyed HMAC state is only set up once and copied for each message.
+
+    Args:
+        secret_intermediate: The secret component derived from the master.
+        slugs: An iterable of site names.
+
+    Returns:
+        A list of passwords in the same order as slugs.
+    """
+    if old:
+        return [make_site_password_old(secret_intermediate, slug)
+                for slug in slugs]
+    keyed = _new_hasher(secret_intermediate)
+    return [_make_site_password_new_keyed(keyed, slug) for slug in slugs]
+
+def iter_site_passwords(secret_intermediate, slugs, old=False, workers=None,
+                        chunk_size=SITE_PASSWORDS_CHUNK_SIZE):
+    """Generate site passwords for a stream of slugs in parallel.
+
+    Slugs are handed to a pool of processes in chunks. Only a few chunks
+    per process are in flight at once, so slugs can be a stream of any
+    length and memory use stays the same.
+
+    Args:
+        secret_intermediate: The secret component derived from the master.
+        slugs: An iterable of site names.
+        workers: Number of processes. Defaults to the number of CPUs.
+        chunk_size: Slugs per task.
+
+    Yields:
+        The passwords in the same order as slugs.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    chunks = _take_chunks(slugs, chunk_size)
+    if workers == 1:
+        for chunk in chunks:
+            for password in make_site_passwords(secret_intermediate, chunk, old=old):
+                yield password
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(
+                make_site_passwords, (secret_intermediate, chunk, old)))
+            if len(pending) >= workers * _CHUNKS_IN_FLIGHT:
+                for password in pending.popleft().get():
+                    yield password
+        while pending:
+            for password in pending.popleft().get():
+                yield password
+    finally:
+        pool.terminate()
+        pool.join()
+
 def make_site_password_new(secret_intermediate, slug, out_extra=False):
     """
     1. Concatenate (slug, generation, counter) separated by newlines.
@@ -65,15 +204,27 @@ def make_site_password_new(secret_intermediate, slug, out_extra=False):
     Args:
         out_extra: Whether to output a tuple of (generation, counter, result).
     """
-    limit = 10000
+    return _make_site_password_new_keyed(
+        _new_hasher(secret_intermediate), slug, out_extra=out_extra)
+
+def _make_site_password_new_keyed(keyed, slug, out_extra=False):
+    """make_site_password_new using a keyed HMAC from _new_hasher."""
+    limit = REROLL_LIMIT
     generation = 0 # can be used for future features.
+    # Only the counter changes between rerolls, so hash the rest once.
+    prefixed = _new_hash_prefixed(keyed, "{}\n{}\n".format(slug, generation))
     for counter in xrange(limit):
-        combined = "\n".join((slug, str(generation), str(counter)))
-        hashed_string = _new_hash(secret_intermediate, combined)
-        hashed_bytes = map(ord, hashed_string)
-        assert len(hashed_bytes) == 32
-        candidate = _bytes_to_password_candidate(hashed_bytes[:15])
-        if is_good_pass(candidate):
+        hashed_string = _new_hash_keyed(prefixed, str(counter))
+        if CHECK_ASSERTS:
+            combined = "\n".join((slug, str(generation), str(counter)))
+            assert hashed_string == _new_hash_keyed(keyed, combined)
+        # Reject on the indices before translating them to characters.
+        encoded = base64.b64encode(hashed_string[:15])
+        if _is_good_b64(encoded):
+            candidate = encoded.translate(_B64_TO_CHARSET)
+            if CHECK_ASSERTS:
+                assert is_good_pass(candidate)
+                assert candidate == _encode_candidate(hashed_string[:15])
             if out_extra:
                 return (generation, counter, candidate)
             else:
@@ -83,29 +234,32 @@ def make_site_password_new(secret_intermediate, slug, out_extra=False):
     print "This is improbable or something is wrong."
     raise Exception("Password reroll limit reached")
 
-def make_site_password_old(secret_intermediate, slug):
+def make_site_password_old(secret_intermediate, slug, out_extra=False):
     """
     1. Concatenate secret_intermediate with slug.
     2. Hash (SHA256) to produce two candidates.
     3. Convert to output character set.
     4. Re-roll if candidates do not satisfy constraints.
+
+    Args:
+        out_extra: Whether to output a tuple of (reroll_count, result).
     """
 
-    limit = 10000
+    limit = REROLL_LIMIT
     reroll_count = 0
 
     hashed_string = _old_hash(secret_intermediate, slug)
 
     for _ in xrange(limit):
-        hashed_bytes = map(ord, hashed_string)
-        assert len(hashed_bytes) == 32
-        candidates = map(_bytes_to_password_candidate,
-                         [hashed_bytes[:15], hashed_bytes[15:30]])
+        if CHECK_ASSERTS:
+            assert len(hashed_string) == 32
+        candidates = [_encode_candidate(hashed_string[:15]),
+                      _encode_candidate(hashed_string[15:30])]
         if is_good_pass(candidates[0]):
-            return candidates[0]
+            return (reroll_count, candidates[0]) if out_extra else candidates[0]
         elif is_good_pass(candidates[1]):
             reroll_count += 1
-            return candidates[1]
+            return (reroll_count, candidates[1]) if out_extra else candidates[1]
         else:
             reroll_count += 2
             # Repeatedly hash to re-roll.
@@ -127,10 +281,32 @@ def is_good_pass(password):
     """
     if len(password) != 20:
         return False
-    return all([any([c in password for c in charset])
-                for charset in (LETTERS, NUMBERS, SYMBOLS)])
+    classes = 0
+    for c in password:
+        classes |= _CHAR_CLASSES[ord(c)]
+        if classes == _ALL_CLASSES:
+            return True
+    return False
 
-def make_storeable(secret_master):
+def is_good_indices(indices):
+    """Validate a password candidate given as charset indices.
+
+    Same rules as is_good_pass, for a candidate that has not been
+    converted to characters yet.
+
+    Args:
+        indices: A sequence of ints in range(64), indexes into CHARSET.
+    """
+    if len(indices) != 20:
+        return False
+    classes = 0
+    for i in indices:
+        classes |= _INDEX_CLASSES[i]
+        if classes == _ALL_CLASSES:
+            return True
+    return False
+
+def make_storeable(secret_master, rounds=STORE_BCRYPT_ROUNDS):
     """Create something that can be safely stored to verify a master.
 
     Bcrypt the master with a RANDOM salt.
@@ -139,7 +315,7 @@ def make_storeable(secret_master):
         A bcrypted string.
     """
     _check_bcrypt_input(secret_master)
-    return bcrypt.hashpw(secret_master, bcrypt.gensalt(rounds=STORE_BCRYPT_ROUNDS))
+    return bcrypt.hashpw(secret_master, bcrypt.gensalt(rounds=rounds))
 
 def check_stored(secret_master, stored_component):
     """Check a master against a stored component.
@@ -157,6 +333,15 @@ def _chunks(lst, size):
     for i in xrange(0, len(lst), size):
         yield lst[i:i+size]
 
+def _take_chunks(iterable, size):
+    """Divide an iterable into lists of up to size items, lazily."""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
 def _bytes_to_pw_chars(bytez):
     """Convert 3 bytes into 4 password characters.
 
@@ -175,7 +360,7 @@ def _bytes_to_pw_chars(bytez):
     # Make sure they're all bytes.
     assert all([x == x & 0xFF for x in bytez])
 
-    charset = LETTERS + NUMBERS + SYMBOLS
+    charset = CHARSET
     assert len(charset) == 64
 
     # Use 6-bit segments of the 24 bits from the 3 bytes
@@ -209,6 +394,29 @@ def _bytes_to_password_candidate(bytez):
     assert len(converted) == 20
     return converted
 
+def _encode_candidate(hashed_string):
+    """Convert a string of 15 bytes into a password candidate.
+
+    Fast equivalent of _bytes_to_password_candidate.
+
+    Returns:
+        A string of 20 characters.
+    """
+    candidate = base64.b64encode(hashed_string).translate(_B64_TO_CHARSET)
+    if CHECK_ASSERTS:
+        assert len(hashed_string) == 15
+        assert candidate == _bytes_to_password_candidate(map(ord, hashed_string))
+    return candidate
+
+def _is_good_b64(encoded):
+    """is_good_indices for indices encoded with the base64 alphabet."""
+    classes = 0
+    for c in encoded:
+        classes |= _B64_CLASSES[ord(c)]
+        if classes == _ALL_CLASSES:
+            return True
+    return False
+
 def _old_hash(secret, data):
     combined = "{}{}".format(data, secret)
     return hashlib.sha256(combined).digest()
@@ -216,6 +424,43 @@ def _old_hash(secret, data):
 def _new_hash(secret, data):
     return hmac.new(key=secret, msg=data, digestmod=hashlib.sha256).digest()
 
+def _new_hasher(secret):
+    """Key an HMAC-SHA256 with secret, to be copied by _new_hash_keyed.
+
+    Returns: The (inner, outer) sha256 states of an hmac.HMAC after
+        absorbing the key. Copying these directly is cheaper than copying
+        the hmac.HMAC.
+    """
+    keyed = hmac.new(secret, digestmod=hashlib.sha256)
+    return (keyed.inner, keyed.outer)
+
+def _new_hash_keyed(keyed, data):
+    """Same as _new_hash but reuses the key schedule of a _new_hasher."""
+    inner, outer = keyed
+    inner = inner.copy()
+    inner.update(data)
+    outer = outer.copy()
+    outer.update(inner.digest())
+    return outer.digest()
+
+def _new_hash_prefixed(keyed, prefix):
+    """A _new_hasher which has already absorbed prefix.
+
+    _new_hash_keyed on the result hashes prefix + data.
+    """
+    inner, outer = keyed
+    inner = inner.copy()
+    inner.update(prefix)
+    return (inner, outer)
+
+def _make_intermediate_or_exception(secret_master):
+    """make_intermediate which returns its exception instead of raising."""
+    try:
+        return make_intermediate(secret_master)
+    except Exception as exc:
+        return exc
+
 def _check_bcrypt_input(x):
-    if len(x) > 72:
-        raise Exception("Bcrypt does not support passwords longer than 72 bytes.")
+    if len(x) > BCRYPT_MAX_LENGTH:
+        raise Exception("Bcrypt does not support passwords longer than {} bytes."
+                        .format(BCRYPT_MAX_LENGTH))
@@ -0,0 +1,133 @@
+"""
+Hashpass algorithm components for Python 3.
+
+The same algorithm as alg, taking and returning bytes. Characters are
+picked and classified with bytes.translate, so no loop over a candidate
+runs in Python. The results match alg for every input.
+"""
+
+import base64
+import hashlib
+import hmac
+
+
+# The constants below are copies of alg's, which is Python 2 only.
+# tests.py checks that they match.
+
+# Salt for generating intermediate, see alg.REUSED_BCRYPT_SALT.
+REUSED_BCRYPT_SALT = b"$2y$10$w1dpoPu1duVEV4rnZPAkLe"
+# Bcrypt ignores input after this many bytes.
+BCRYPT_MAX_LENGTH = 72
+
+# Maximum candidates to try for a site password.
+REROLL_LIMIT = 10000
+
+LETTERS = b"abcdefghjkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXY"
+NUMBERS = b"3456789"
+SYMBOLS = b"#*@()+={}?"
+CHARSET = LETTERS + NUMBERS + SYMBOLS
+
+# Base64 splits bytes into the same 6-bit groups as alg._bytes_to_pw_chars,
+# so translating its alphabet to CHARSET encodes a candidate in one pass.
+_B64_ALPHABET = (b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+                 b"0123456789+/")
+_B64_TO_CHARSET = bytes.maketrans(_B64_ALPHABET, CHARSET)
+
+# Translate a candidate to one class byte per character, then a good one
+# has all three. Three scans in C beat one loop in Python.
+_CLASSES = b"L" * len(LETTERS) + b"N" * len(NUMBERS) + b"S" * len(SYMBOLS)
+_B64_TO_CLASS = bytes.maketrans(_B64_ALPHABET, _CLASSES)
+_CHARSET_TO_CLASS = bytes.maketrans(CHARSET, _CLASSES)
+
+# HMAC-SHA256 block size and pads, see RFC 2104.
+_HMAC_BLOCK_SIZE = 64
+_HMAC_INNER_PAD = bytes(x ^ 0x36 for x in range(256))
+_HMAC_OUTER_PAD = bytes(x ^ 0x5C for x in range(256))
+
+
+def make_intermediate(secret_master):
+    """Generate a deterministic derived key from the master.
+
+    Same as alg.make_intermediate. bcrypt is only imported here, so site
+    passwords can be made without it.
+
+    Returns:
+        An intermediate which is a bcrypt output as bytes.
+    """
+    if len(secret_master) > BCRYPT_MAX_LENGTH:
+        raise Exception("Bcrypt does not support passwords longer than {} bytes."
+                        .format(BCRYPT_MAX_LENGTH))
+    import bcrypt
+    return bcrypt.hashpw(secret_master, REUSED_BCRYPT_SALT)
+
+def make_site_password_new(secret_intermediate, slug, out_extra=False):
+    """Same as alg.make_site_password_new, for bytes.
+
+    Args:
+        out_extra: Whether to output a tuple of (generation, counter, result).
+    """
+    inner, outer = _new_hasher(secret_intermediate)
+    generation = 0 # can be used for future features.
+    # Only the counter changes between rerolls, so hash the rest once.
+    inner.update(b"%s\n%d\n" % (slug, generation))
+    for counter in range(REROLL_LIMIT):
+        hasher = inner.copy()
+        hasher.update(b"%d" % counter)
+        hashed = outer.copy()
+        hashed.update(hasher.digest())
+        encoded = base64.b64encode(hashed.digest()[:15])
+        if _is_good_classes(encoded.translate(_B64_TO_CLASS)):
+            candidate = encoded.translate(_B64_TO_CHARSET)
+            if out_extra:
+                return (generation, counter, candidate)
+            else:
+                return candidate
+
+    raise Exception("Password reroll limit reached")
+
+def make_site_password_old(secret_intermediate, slug, out_extra=False):
+    """Same as alg.make_site_password_old, for bytes.
+
+    Args:
+        out_extra: Whether to output a tuple of (reroll_count, result).
+    """
+    reroll_count = 0
+    hashed = hashlib.sha256(slug + secret_intermediate).digest()
+    for _ in range(REROLL_LIMIT):
+        # Both candidates in one call, the 40 characters split in two.
+        encoded = base64.b64encode(hashed[:30]).translate(_B64_TO_CHARSET)
+        for candidate in (encoded[:20], encoded[20:]):
+            if _is_good_classes(candidate.translate(_CHARSET_TO_CLASS)):
+                return (reroll_count, candidate) if out_extra else candidate
+            reroll_count += 1
+        # This rehash throws out the last 2 bytes each round.
+        hashed = hashlib.sha256(encoded).digest()
+
+    raise Exception("Password reroll limit reached")
+
+def is_good_pass(password):
+    """Validate a password candidate, see alg.is_good_pass."""
+    return (len(password) == 20 and
+            _is_good_classes(password.translate(_CHARSET_TO_CLASS)))
+
+def _is_good_classes(classes):
+    return b"L" in classes and b"N" in classes and b"S" in classes
+
+def _new_hasher(secret):
+    """Key an HMAC-SHA256 with secret, as in RFC 2104.
+
+    A secret longer than a block is hashed first, then padded with zeros
+    to the block size and xored with the inner and outer pads. Copying
+    these states is cheaper than hmac.digest, which sets the key up again
+    on every call.
+
+    Returns: The (inner, outer) sha256 states after absorbing the padded key.
+    """
+    if len(secret) > _HMAC_BLOCK_SIZE:
+        secret = hashlib.sha256(secret).digest()
+    secret = secret.ljust(_HMAC_BLOCK_SIZE, b"\0")
+    return (hashlib.sha256(secret.translate(_HMAC_INNER_PAD)),
+            hashlib.sha256(secret.translate(_HMAC_OUTER_PAD)))
+
+def _new_hash(secret, data):
+    return hmac.digest(secret, data, "sha256")
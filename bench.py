@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the hashpass algorithm.
+
+Usage:
+    bench.py batch [--slugs=<n>] [--repeat=<n>]
+    bench.py intermediates [--masters=<n>] [--workers=<list>]
+    bench.py stats [--samples=<n>] [--costs=<list>] [--bcrypt-samples=<n>] [--out=<file>]
+    bench.py imports [--repeat=<n>]
+    bench.py rerolls [--reroll-slugs=<list>] [--iterations=<n>] [--repeat=<n>]
+    bench.py py3 [--slugs=<n>] [--repeat=<n>] [--python3=<path>]
+
+Options:
+    --slugs=<n>       Number of slugs to derive per run [default: 2000]
+    --repeat=<n>      Number of runs, the fastest is reported [default: 5]
+    --masters=<n>     Number of masters to derive intermediates for [default: 64]
+    --workers=<list>  Comma separated worker counts to compare,
+                      defaults to powers of two up to the number of CPUs.
+    --samples=<n>         Number of random intermediates and slugs [default: 10000]
+    --costs=<list>        Comma separated bcrypt costs to time [default: 10,13]
+    --bcrypt-samples=<n>  Number of times to run bcrypt per cost [default: 3]
+    --out=<file>          Write the JSON report to a file instead of stdout.
+    --reroll-slugs=<list>  Comma separated slugs, defaults to ones from
+                           tests.py which reroll 0 to 6 times.
+    --iterations=<n>      Derivations per slug per run [default: 2000]
+    --python3=<path>      Python 3 interpreter to run alg3 with [default: python3]
+"""
+from docopt import docopt
+import base64
+import bcrypt
+import collections
+import hashlib
+import hmac
+import json
+import math
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+import timeit
+import alg
+
+INTERMEDIATE = "$2y$10$w1dpoPu1duVEV4rnZPAkLe8kxqbSe4xmE4jVqL4IcwVLWluqZNI3G"
+
+# Slugs which reroll 0, 3, 5 and 6 times under INTERMEDIATE.
+REROLL_SLUGS = ["rhythm0", "rhythm354", "rhythm30362", "rhythm353402"]
+
+# Imports to time, as (name, code). hashpass is a script, not a module.
+IMPORT_TARGETS = [
+    ("agent_client", "import agent_client"),
+    ("hashpass", "import imp; imp.load_source('hashpass', 'hashpass')"),
+    ("hashpasslib", "import hashpasslib"),
+    ("agent", "import agent"),
+]
+
+# Modules which asking a running agent for a password should not import.
+HEAVY_MODULES = ["bcrypt", "daemon", "fasteners", "multiprocessing",
+                 "pinentry", "hashpasslib", "alg", "agent"]
+
+
+def best_time(fn, repeat):
+    """Run fn repeat times and return the fastest wall time in seconds."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_batch(n_slugs, repeat):
+    """Compare make_site_passwords against make_site_password in a loop."""
+    slugs = ["service-account-{}".format(i) for i in xrange(n_slugs)]
+    for old in (False, True):
+        loop = best_time(lambda: [
+            alg.make_site_password(INTERMEDIATE, slug, old=old)
+            for slug in slugs], repeat)
+        batch = best_time(lambda: alg.make_site_passwords(
+            INTERMEDIATE, slugs, old=old), repeat)
+        print "{} ({} slugs)".format("old" if old else "new", n_slugs)
+        print "  loop:  {:8.2f} us/slug".format(loop / n_slugs * 1e6)
+        print "  batch: {:8.2f} us/slug".format(batch / n_slugs * 1e6)
+        print "  speedup: {:.2f}x".format(loop / batch)
+
+
+def bench_intermediates(n_masters, worker_counts):
+    """Time make_intermediates for increasing numbers of workers."""
+    masters = ["master-{}".format(i) for i in xrange(n_masters)]
+    print "make_intermediates ({} masters, {} CPUs)".format(
+        n_masters, multiprocessing.cpu_count())
+    base = None
+    for workers in worker_counts:
+        start = time.time()
+        alg.make_intermediates(masters, workers=workers)
+        elapsed = time.time() - start
+        if base is None:
+            base = elapsed
+        print "  {:3d} workers: {:8.2f} ms/master  {:5.2f}x".format(
+            workers, elapsed / n_masters * 1e3, base / elapsed)
+
+
+def bench_stats(n_samples, costs, n_bcrypt_samples):
+    """Collect reroll and latency statistics for both algorithms.
+
+    Returns: A JSON serializable report.
+    """
+    rng = random.SystemRandom()
+    samples = [(_random_intermediate(rng), _random_slug(rng))
+               for _ in xrange(n_samples)]
+    report = {
+        "samples": n_samples,
+        "reroll_limit": alg.REROLL_LIMIT,
+        "new": _site_password_stats(samples, 1, lambda intermediate, slug:
+            alg.make_site_password_new(intermediate, slug, out_extra=True)[1]),
+        # The old algorithm tries two candidates per hash.
+        "old": _site_password_stats(samples, 2, lambda intermediate, slug:
+            alg.make_site_password_old(intermediate, slug, out_extra=True)[0]),
+        "bcrypt": {},
+    }
+
+    master = _random_slug(rng)
+    for cost in costs:
+        stored = alg.make_storeable(master, rounds=cost)
+        report["bcrypt"][str(cost)] = {
+            "make_intermediate": _latency_stats([
+                _timed(_make_intermediate_at_cost, master, cost)
+                for _ in xrange(n_bcrypt_samples)]),
+            "make_storeable": _latency_stats([
+                _timed(alg.make_storeable, master, rounds=cost)
+                for _ in xrange(n_bcrypt_samples)]),
+            "check_stored": _latency_stats([
+                _timed(alg.check_stored, master, stored)
+                for _ in xrange(n_bcrypt_samples)]),
+        }
+    return report
+
+
+def bench_rerolls(slugs, iterations, repeat):
+    """Compare copying an hmac.HMAC and hashing the whole message on every
+    reroll with copying bare sha256 states after the prefix."""
+    keyed = alg._new_hasher(INTERMEDIATE)
+    hmac_keyed = hmac.new(INTERMEDIATE, digestmod=hashlib.sha256)
+    for slug in slugs:
+        generation, counter, password = alg._make_site_password_new_keyed(
+            keyed, slug, out_extra=True)
+        assert _make_site_password_new_unprefixed(hmac_keyed, slug) == password
+        full = best_time(lambda: [
+            _make_site_password_new_unprefixed(hmac_keyed, slug)
+            for _ in xrange(iterations)], repeat)
+        prefixed = best_time(lambda: [
+            alg._make_site_password_new_keyed(keyed, slug)
+            for _ in xrange(iterations)], repeat)
+        print "{} ({} rerolls)".format(slug, counter)
+        print "  whole message: {:8.2f} us/password".format(full / iterations * 1e6)
+        print "  prefix once:   {:8.2f} us/password".format(prefixed / iterations * 1e6)
+        print "  speedup: {:.2f}x".format(full / prefixed)
+
+
+def bench_py3(n_slugs, repeat, python3):
+    """Compare alg under this interpreter with alg3 under python3."""
+    slugs = ["service-account-{}".format(i) for i in xrange(n_slugs)]
+    py2 = {
+        "new": best_time(lambda: [
+            alg.make_site_password_new(INTERMEDIATE, slug) for slug in slugs],
+            repeat),
+        "old": best_time(lambda: [
+            alg.make_site_password_old(INTERMEDIATE, slug) for slug in slugs],
+            repeat),
+    }
+    out = subprocess.check_output(
+        [python3, "-B", "-c", _PY3_BENCH_SCRIPT, INTERMEDIATE, str(repeat)]
+        + slugs, cwd=os.path.dirname(os.path.abspath(__file__)))
+    py3 = json.loads(out)
+    assert py3.pop("passwords") == [
+        alg.make_site_password_new(INTERMEDIATE, slug) for slug in slugs]
+    for name in ["new", "old", "new_hmac_digest"]:
+        print name
+        if name in py2:
+            print "  python 2 alg:  {:10.0f} passwords/s".format(n_slugs / py2[name])
+        print "  python 3 alg3: {:10.0f} passwords/s".format(n_slugs / py3[name])
+        if name in py2:
+            print "  speedup: {:.2f}x".format(py2[name] / py3[name])
+
+
+# Times alg3 under python3.
+# Usage: python3 -c _PY3_BENCH_SCRIPT <intermediate> <repeat> <slug>...
+_PY3_BENCH_SCRIPT = """
+import base64, json, sys, time
+import alg3
+
+def best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def make_site_password_new_hmac_digest(secret_intermediate, slug):
+    # One hmac.digest per candidate instead of copying keyed states.
+    for counter in range(alg3.REROLL_LIMIT):
+        hashed = alg3._new_hash(secret_intermediate, b"%s\\n0\\n%d" % (slug, counter))
+        encoded = base64.b64encode(hashed[:15])
+        if alg3._is_good_classes(encoded.translate(alg3._B64_TO_CLASS)):
+            return encoded.translate(alg3._B64_TO_CHARSET)
+
+intermediate = sys.argv[1].encode()
+repeat = int(sys.argv[2])
+slugs = [slug.encode() for slug in sys.argv[3:]]
+results = {"passwords": [alg3.make_site_password_new(intermediate, slug).decode()
+                         for slug in slugs]}
+assert results["passwords"] == [
+    make_site_password_new_hmac_digest(intermediate, slug).decode()
+    for slug in slugs]
+for name, fn in [("new", alg3.make_site_password_new),
+                 ("old", alg3.make_site_password_old),
+                 ("new_hmac_digest", make_site_password_new_hmac_digest)]:
+    results[name] = best_time(
+        lambda: [fn(intermediate, slug) for slug in slugs], repeat)
+print(json.dumps(results))
+"""
+
+
+def _make_site_password_new_unprefixed(hmac_keyed, slug):
+    """The new algorithm as it was before hashing the prefix only once."""
+    generation = 0
+    for counter in xrange(alg.REROLL_LIMIT):
+        combined = "\n".join((slug, str(generation), str(counter)))
+        hasher = hmac_keyed.copy()
+        hasher.update(combined)
+        encoded = base64.b64encode(hasher.digest()[:15])
+        if alg._is_good_b64(encoded):
+            return encoded.translate(alg._B64_TO_CHARSET)
+
+
+def bench_imports(repeat):
+    """Time each of IMPORT_TARGETS in a fresh interpreter.
+
+    Python 2 has no -X importtime, so every import runs in its own process
+    and the startup time of an empty interpreter is subtracted.
+    """
+    base = best_time(lambda: _run_python("pass"), repeat)
+    print "interpreter startup: {:6.1f} ms".format(base * 1e3)
+    for name, code in IMPORT_TARGETS:
+        elapsed = best_time(lambda: _run_python(code), repeat) - base
+        modules = imported_modules(code)
+        heavy = [module for module in HEAVY_MODULES if module in modules]
+        print "  {:12s} {:6.1f} ms {:4d} modules  heavy: {}".format(
+            name, elapsed * 1e3, len(modules), ", ".join(heavy) or "none")
+
+
+def imported_modules(code):
+    """List the modules which running code imports in a fresh interpreter."""
+    out = subprocess.check_output([sys.executable, "-B", "-c", "\n".join([
+        "import sys",
+        "before = set(sys.modules)",
+        code,
+        "print '\\n'.join(sorted(name for name, module in sys.modules.items()",
+        "                         if module is not None and name not in before))",
+    ])], cwd=os.path.dirname(os.path.abspath(__file__)))
+    return out.split()
+
+
+def _run_python(code):
+    subprocess.check_call([sys.executable, "-B", "-c", code],
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def _site_password_stats(samples, candidates_per_try, derive):
+    """Reroll histogram and latency for derive(intermediate, slug) -> rerolls.
+
+    For the new algorithm rerolls is the counter, for the old algorithm
+    the number of rejected candidates.
+    """
+    histogram = collections.Counter()
+    latencies = []
+    for intermediate, slug in samples:
+        start = timeit.default_timer()
+        rerolls = derive(intermediate, slug)
+        latencies.append(timeit.default_timer() - start)
+        histogram[rerolls] += 1
+
+    candidates = sum((rerolls + 1) * n for rerolls, n in histogram.iteritems())
+    reject_rate = 1 - float(len(samples)) / candidates
+    return {
+        "rerolls": {str(rerolls): n for rerolls, n in sorted(histogram.items())},
+        "mean_rerolls": float(candidates) / len(samples) - 1,
+        "max_rerolls": max(histogram),
+        "candidate_reject_rate": reject_rate,
+        # Estimated chance of a slug hitting the reroll limit.
+        "log10_p_limit": (alg.REROLL_LIMIT * candidates_per_try
+                          * math.log10(reject_rate)
+                          if reject_rate > 0 else None),
+        "latency": _latency_stats(latencies),
+    }
+
+
+def _latency_stats(latencies):
+    """Summarize latencies in seconds as microseconds."""
+    latencies = sorted(latencies)
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e6
+    return {
+        "p50_us": percentile(0.5),
+        "p99_us": percentile(0.99),
+        "max_us": latencies[-1] * 1e6,
+    }
+
+
+def _timed(fn, *args, **kwargs):
+    """Run fn and return how long it took in seconds."""
+    start = timeit.default_timer()
+    fn(*args, **kwargs)
+    return timeit.default_timer() - start
+
+
+def _make_intermediate_at_cost(master, cost):
+    """What make_intermediate would do with a salt of a different cost."""
+    salt = alg.REUSED_BCRYPT_SALT.replace("$10$", "${:02d}$".format(cost))
+    return bcrypt.hashpw(master, salt)
+
+
+def _random_intermediate(rng):
+    """A random string shaped like an intermediate.
+
+    Real ones take a bcrypt each, and for the HMAC key any secret
+    of the same length and alphabet is as good.
+    """
+    alphabet = "./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+    return alg.REUSED_BCRYPT_SALT + "".join(rng.choice(alphabet) for _ in xrange(31))
+
+
+def _random_slug(rng):
+    return os.urandom(rng.randint(4, 16)).encode("hex")
+
+
+def _default_worker_counts():
+    counts = [1]
+    while counts[-1] * 2 <= multiprocessing.cpu_count():
+        counts.append(counts[-1] * 2)
+    if counts[-1] != multiprocessing.cpu_count():
+        counts.append(multiprocessing.cpu_count())
+    return counts
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    if arguments["batch"]:
+        bench_batch(int(arguments["--slugs"]), int(arguments["--repeat"]))
+    if arguments["intermediates"]:
+        if arguments["--workers"]:
+            worker_counts = map(int, arguments["--workers"].split(","))
+        else:
+            worker_counts = _default_worker_counts()
+        bench_intermediates(int(arguments["--masters"]), worker_counts)
+    if arguments["stats"]:
+        report = bench_stats(int(arguments["--samples"]),
+                             map(int, arguments["--costs"].split(",")),
+                             int(arguments["--bcrypt-samples"]))
+        if arguments["--out"]:
+            with open(arguments["--out"], "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True,
+                          separators=(",", ": "))
+        else:
+            json.dump(report, sys.stdout, indent=2, sort_keys=True,
+                      separators=(",", ": "))
+            print
+    if arguments["imports"]:
+        bench_imports(int(arguments["--repeat"]))
+    if arguments["rerolls"]:
+        if arguments["--reroll-slugs"]:
+            slugs = arguments["--reroll-slugs"].split(",")
+        else:
+            slugs = REROLL_SLUGS
+        bench_rerolls(slugs, int(arguments["--iterations"]),
+                      int(arguments["--repeat"]))
+    if arguments["py3"]:
+        bench_py3(int(arguments["--slugs"]), int(arguments["--repeat"]),
+                  arguments["--python3"])
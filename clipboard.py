@@ -0,0 +1,228 @@
+"""
+Clipboard which forgets what was copied after a while.
+
+The backend (xclip, or pyperclip when there is no xclip) is found once per
+process. Each copy replaces the last and restarts a single timer, which
+clears the clipboard when it runs out unless something else was copied in
+the meantime. If the process exits before then, the pending clear is handed
+to a detached clearer process.
+"""
+import atexit
+import hashlib
+import os
+import os.path
+import subprocess
+import sys
+import threading
+import time
+
+
+# Seconds to keep a copied text on the clipboard.
+CLIP_SECONDS = 30
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def send_to_clipboard(text):
+    """Copy text to the clipboard, to be cleared after CLIP_SECONDS."""
+    get_clipboard().copy(text, CLIP_SECONDS)
+
+
+def get_clipboard():
+    """Get the clipboard for this process, finding the backend on first use."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Clipboard(find_backend())
+            atexit.register(_default.hand_off)
+        return _default
+
+
+def find_backend():
+    """Pick the best clipboard backend available."""
+    xclip = _which("xclip")
+    if xclip is not None:
+        return XclipBackend(xclip, klipper_qdbus=_which("qdbus"))
+    return PyperclipBackend()
+
+
+class XclipBackend(object):
+    """Copies with xclip, which stays running to hold the selection.
+
+    A new copy takes the selection over, and the xclip holding the old one
+    exits on its own.
+    """
+    def __init__(self, xclip, klipper_qdbus=None):
+        self._xclip = xclip
+        self._qdbus = klipper_qdbus
+
+    def copy(self, text):
+        with open(os.devnull, "r+b") as devnull:
+            proc = subprocess.Popen([self._xclip, "-selection", "clipboard"],
+                                    stdin=subprocess.PIPE,
+                                    stdout=devnull, stderr=devnull)
+            proc.communicate(text)
+        if proc.returncode != 0:
+            raise ClipboardException("Could not copy to the clipboard.")
+
+    def paste(self):
+        """Returns: The clipboard contents or None if they can't be read."""
+        with open(os.devnull, "r+b") as devnull:
+            proc = subprocess.Popen([self._xclip, "-o", "-selection", "clipboard"],
+                                    stdin=devnull, stdout=subprocess.PIPE,
+                                    stderr=devnull)
+            out, _ = proc.communicate()
+        if proc.returncode != 0:
+            return None
+        return out
+
+    def clear(self):
+        if self._qdbus is not None:
+            with open(os.devnull, "r+b") as devnull:
+                subprocess.call([self._qdbus, "org.kde.klipper", "/klipper",
+                                 "org.kde.klipper.klipper.clearClipboardHistory"],
+                                stdin=devnull, stdout=devnull, stderr=devnull)
+        self.copy("")
+
+
+class PyperclipBackend(object):
+    def __init__(self):
+        import pyperclip
+        self._pyperclip = pyperclip
+
+    def copy(self, text):
+        self._pyperclip.copy(text)
+
+    def paste(self):
+        return self._pyperclip.paste()
+
+    def clear(self):
+        self._pyperclip.copy("")
+
+
+class ClipboardException(Exception):
+    pass
+
+
+class Clipboard(object):
+    """Holds at most one copied text and clears it when its time is up.
+
+    Args:
+        backend: Object with copy(text), paste() and clear().
+        clock: Time source in seconds.
+    """
+    def __init__(self, backend, clock=time.time):
+        self._backend = backend
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._timer = None
+        # Digest of the text to clear and when to clear it.
+        self._digest = None
+        self._deadline = None
+
+    def copy(self, text, lifetime):
+        """Copy text, to be cleared after lifetime seconds.
+
+        Replaces any earlier copy along with its pending clear.
+        """
+        with self._lock:
+            self._cancel()
+            self._backend.copy(text)
+            self._digest = _digest(text)
+            self._deadline = self._clock() + lifetime
+            self._timer = threading.Timer(lifetime, self._expire, (self._digest,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def pending(self):
+        """Returns: Whether there is a copy which has not been cleared yet."""
+        with self._lock:
+            return self._digest is not None
+
+    def hand_off(self):
+        """Leave a pending clear to a detached process.
+
+        Call before exiting. The clearer still only clears if the clipboard
+        holds what this process copied.
+        """
+        with self._lock:
+            if self._digest is None:
+                return
+            remaining = max(0, self._deadline - self._clock())
+            digest = self._digest
+            self._cancel()
+        script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+        with open(os.devnull, "r+b") as devnull:
+            proc = subprocess.Popen(
+                [sys.executable, script, "--clear-after", repr(remaining)],
+                stdin=subprocess.PIPE, stdout=devnull, stderr=devnull,
+                close_fds=True, preexec_fn=os.setsid)
+            proc.stdin.write(digest)
+            proc.stdin.close()
+
+    def close(self):
+        """Drop the pending clear and wait for its timer to stop.
+
+        Whatever was copied stays on the clipboard.
+        """
+        with self._lock:
+            timer = self._timer
+            self._cancel()
+        if timer is not None:
+            timer.join()
+
+    def _expire(self, digest):
+        with self._lock:
+            if self._digest != digest:
+                # Replaced by a newer copy.
+                return
+            self._cancel()
+            clear_if_unchanged(self._backend, digest)
+
+    def _cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None
+        self._digest = None
+        self._deadline = None
+
+
+def clear_if_unchanged(backend, digest):
+    """Clear the clipboard if it still holds the text with this digest.
+
+    Returns: Whether the clipboard was cleared.
+    """
+    current = backend.paste()
+    if current is not None and _digest(current) != digest:
+        return False
+    backend.clear()
+    return True
+
+
+def _digest(text):
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return hashlib.sha256(text).hexdigest()
+
+
+def _which(name):
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def _clear_after_main(seconds):
+    digest = sys.stdin.read().strip()
+    time.sleep(seconds)
+    clear_if_unchanged(find_backend(), digest)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--clear-after":
+        _clear_after_main(float(sys.argv[2]))
+    else:
+        print "Usage: clipboard.py --clear-after <seconds> < digest"
+        sys.exit(1)
@@ -8,9 +8,13 @@ import hashpasslib
 import hashlib
 import Tkinter
 import tkFont
+import sys
 import threading
 import time
 
+# Milliseconds between checks on background work.
+POLL_MS = 50
+
 
 class HashPass(Tkinter.Frame, object):
   """Application main frame.
@@ -22,6 +26,11 @@ class HashPass(Tkinter.Frame, object):
     self.parent.title("HashPass")
 
     self.clipboard_thread = DelayedClipboardThread()
+    self.derivation_worker = DerivationWorker(make_site_password)
+    # Whether poll_derivation is scheduled.
+    self.polling_derivation = False
+    # Whether the master is being checked in the background.
+    self.checking_master = False
 
     # Keyboard shortcuts for quit.
     for keys in ["<Control-q>", "<Control-c>", "<Control-d>", "<Control-w>"]:
@@ -55,7 +64,7 @@ class HashPass(Tkinter.Frame, object):
 
     self.pack()
 
-  def ask_for_master(self, message=None):
+  def ask_for_master(self, message=None, keep_text=False):
     print "asked"
     if message == None:
         if hashpasslib.read_stored_master() == None:
@@ -65,34 +74,70 @@ class HashPass(Tkinter.Frame, object):
             message = "Enter your master password."
             self.no_saved_master = False
     self.asked_for_master = True #Unset by pressing enter
-    self.clear_textbox()
+    if not keep_text:
+      self.clear_textbox()
     self.label_clipboard.config(text=(message))
 
-  def ask_for_website(self):
-    self.clear_textbox()
+  def ask_for_website(self, keep_text=False):
+    if not keep_text:
+      self.clear_textbox()
     self.entry.config(show="")
     self.label_clipboard.config(text=("Enter the website name to generate a password."))
+    if keep_text:
+      # Use whatever was typed while waiting.
+      self.on_change_entry()
 
   def clear_textbox(self):
     self.entry_var.set("")
 
   def on_change_entry(self):
     print "onchange"
-    if self.asked_for_master:
+    if self.asked_for_master or self.checking_master:
       return
     plain = self.entry_var.get()
     if len(plain) == 0:
+      self.derivation_worker.cancel()
       self.label_hash.config(text="")
       return
-    hashed = hashpasslib.make_password(plain, old=False)
+    self.derivation_worker.request(plain)
+    if not self.polling_derivation:
+      self.polling_derivation = True
+      self.after(POLL_MS, self.poll_derivation)
+
+  def poll_derivation(self):
+    """Show the password for the latest slug once it is derived."""
+    if not self.derivation_worker.pending():
+      self.polling_derivation = False
+      return
+    try:
+      hashed = self.derivation_worker.poll()
+    except Exception as exc:
+      self.polling_derivation = False
+      self.on_derivation_error(exc)
+      return
+    if hashed is not None:
+      self.polling_derivation = False
+      self.show_password(hashed)
+    else:
+      self.after(POLL_MS, self.poll_derivation)
+
+  def show_password(self, hashed):
     self.label_hash.config(text=hashed)
     self.clipboard_thread.send_to_clipboard_at_some_point(hashed)
     self.label_clipboard.config(text=(
       "Copied to clipboard. "
       "Enter to clear."))
 
+  def on_derivation_error(self, exc):
+    """Show why the password for the latest slug could not be made."""
+    self.label_hash.config(text="")
+    self.label_clipboard.config(text=(
+      "Could not make a password: {}".format(exc)))
+
   def on_press_enter(self):
     print "enter"
+    if self.checking_master:
+      return
     if self.asked_for_master:
       self.on_submit_master(self.entry_var.get())
     else:
@@ -105,16 +150,187 @@ class HashPass(Tkinter.Frame, object):
   def on_submit_master(self, master):
     print "submit master"
     self.asked_for_master = False
+    # Bcrypt is slow, so do it in the background.
+    # Keep the entry working so nothing typed meanwhile is lost.
+    self.checking_master = True
+    self.clear_textbox()
     if self.no_saved_master:
-      hashpasslib.store_master(master)
-      self.no_saved_master = False
-      self.ask_for_master("Enter the password again.")
+      self.poll_background(BackgroundCall(hashpasslib.store_master, master),
+                           self.on_master_stored, "Saving master password")
+    else:
+      self.poll_background(BackgroundCall(check_and_use_master, master),
+                           self.on_master_checked, "Checking master password")
+
+  def on_master_stored(self, _):
+    self.checking_master = False
+    self.no_saved_master = False
+    self.ask_for_master("Enter the password again.", keep_text=True)
+
+  def on_master_checked(self, correct):
+    self.checking_master = False
+    if correct:
+      self.ask_for_website(keep_text=True)
     else:
-      if hashpasslib.is_correct_master(master):
-        hashpasslib.use_master(master, use_bcrypt=True)
-        self.ask_for_website()
+      self.ask_for_master("That didn't match your saved master. ", keep_text=True)
+
+  def on_background_error(self, exc):
+    """Give up on a master which could not be checked or saved."""
+    self.checking_master = False
+    self.ask_for_master("Could not use that master: {}\nEnter your master password."
+                        .format(exc))
+
+  def poll_background(self, call, callback, message, polls=0):
+    """Show progress until call is done, then callback with its result."""
+    if call.done():
+      try:
+        result = call.result()
+      except Exception as exc:
+        self.on_background_error(exc)
+        return
+      callback(result)
+      return
+    dots = "." * (polls // 5 % 4)
+    self.label_clipboard.config(text=(message + dots))
+    self.after(POLL_MS, self.poll_background, call, callback, message, polls + 1)
+
+
+def make_site_password(slug):
+  """Make the new style password for a slug typed into the entry."""
+  if isinstance(slug, unicode):
+    # Tkinter gives unicode for anything but ascii, encode it like the agent.
+    slug = slug.encode("utf-8")
+  return hashpasslib.make_password(slug, old=False)
+
+def check_and_use_master(master):
+  """Use the master if it is correct.
+
+  Returns: Whether it is correct.
+  """
+  if not hashpasslib.is_correct_master(master):
+    return False
+  hashpasslib.use_master(master, use_bcrypt=True)
+  return True
+
+
+class BackgroundCall(object):
+  """Call a function on a worker thread, for the GUI to poll."""
+  def __init__(self, fn, *args):
+    self._done = threading.Event()
+    self._result = None
+    self._exc_info = None
+
+    self._thread = threading.Thread(target=self._run, args=(fn, args))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def done(self):
+    return self._done.is_set()
+
+  def result(self):
+    """Get the return value, or raise what the function raised."""
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def _run(self, fn, args):
+    try:
+      self._result = fn(*args)
+    except Exception:
+      self._exc_info = sys.exc_info()
+    self._done.set()
+
+
+class DerivationWorker(object):
+  """Derives site passwords on a worker thread.
+
+  Only the latest slug requested gets derived. Slugs requested while a
+  derivation runs replace each other, and like whiplash.make_channel,
+  the result for anything but the latest request is dropped.
+  """
+  def __init__(self, derive):
+    self._derive = derive
+    self._lock = threading.Lock()
+    self._event = threading.Event()
+    # Number of the latest request.
+    self._request_number = 0
+    # (request number, slug) waiting for the worker, or None.
+    self._job = None
+    # Password for the latest request once derived, or None.
+    self._result = None
+    # Exception deriving for the latest request, or None.
+    self._error = None
+    # Number of the request being derived, or None.
+    self._working_on = None
+
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def request(self, slug):
+    """Request the password for a slug, superseding earlier requests.
+
+    The password can then be polled for.
+    """
+    with self._lock:
+      self._request_number += 1
+      self._result = None
+      self._error = None
+      self._job = (self._request_number, slug)
+    self._event.set()
+
+  def pending(self):
+    """Whether the latest request is still to be polled."""
+    with self._lock:
+      return (self._job is not None or self._result is not None or
+              self._error is not None or self._busy())
+
+  def poll(self):
+    """Get the password for the latest request if it is ready, else None.
+
+    Raises: The exception deriving it raised, if it failed.
+    """
+    with self._lock:
+      result, self._result = self._result, None
+      error, self._error = self._error, None
+    if error is not None:
+      raise error
+    return result
+
+  def cancel(self):
+    """Drop the latest request."""
+    with self._lock:
+      self._request_number += 1
+      self._job = None
+      self._result = None
+      self._error = None
+
+  def _busy(self):
+    """Whether the worker is deriving for the latest request."""
+    return self._working_on == self._request_number
+
+  def _run(self):
+    while True:
+      self._event.wait()
+      with self._lock:
+        job, self._job = self._job, None
+        self._event.clear()
+        if job is None:
+          continue
+        self._working_on = job[0]
+      number, slug = job
+      try:
+        password = self._derive(slug)
+      except Exception as exc:
+        with self._lock:
+          if number == self._request_number:
+            self._error = exc
       else:
-        self.ask_for_master("That didn't match your saved master. ")
+        with self._lock:
+          if number == self._request_number:
+            self._result = password
+      finally:
+        with self._lock:
+          self._working_on = None
 
 
 class DelayedClipboardThread(object):
@@ -2,77 +2,257 @@
 import os
 import os.path
 import errno
-import subprocess
+import threading
+import time
 import alg
+import ttlcache
+from clipboard import CLIP_SECONDS, send_to_clipboard
 
 MASTER_PW_DIR = os.path.expanduser("~/.config/hashpass/")
 MASTER_PW_FILE = "password.bcrypt"
 MASTER_PW_PATH = MASTER_PW_DIR + MASTER_PW_FILE
 
-session_master = None
-session_intermediate = None
+# Stored master as of the last read: ((device, inode, mtime, size), contents).
+_stored_master_cache = None
 
-CLIP_SECONDS = 30
+# Site passwords to remember for the session intermediate, 0 to disable.
+PASSWORD_CACHE_SIZE = 64
+# Seconds to remember a site password.
+PASSWORD_CACHE_LIFETIME = 60 * 60
 
-def send_to_clipboard(text):
-    if subprocess.call(["which", "xclip"], stdout=open(os.devnull, 'wb')) == 0:
-        cliptimesh = os.path.abspath(os.path.join(os.path.dirname(__file__), "cliptime.sh"))
-        subprocess.call([cliptimesh, str(CLIP_SECONDS), text])
-    else:
-        import pyperclip
-        pyperclip.copy(text)
+
+class PasswordCache(object):
+    """Bounded LRU cache of site passwords for one intermediate.
+
+    Keyed by (slug, old). Each entry expires lifetime seconds after it
+    was added. Passwords are held in bytearrays which are zeroed on
+    eviction. Call clear() whenever the intermediate changes.
+    Safe to call from many threads at once.
+    """
+    def __init__(self, size=None, lifetime=None, clock=time.time):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Map from (slug, old) to (password bytearray,).
+        self._cache = ttlcache.TTLCache(
+            PASSWORD_CACHE_SIZE if size is None else size,
+            PASSWORD_CACHE_LIFETIME if lifetime is None else lifetime,
+            clock)
+        # Bumped by clear(), so passwords made before then are not cached.
+        self._generation = 0
+
+    @property
+    def size(self):
+        return self._cache.size
+
+    @property
+    def lifetime(self):
+        return self._cache.lifetime
+
+    def get_or_make(self, slug, old, make):
+        """Get a cached password, or make it with make(slug, old) and cache it.
+
+        make is called without holding the lock and must read the
+        intermediate itself, after which a clear() keeps its result out.
+        """
+        key = (slug, old)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self.hits += 1
+                return str(entry[0])
+            self.misses += 1
+            generation = self._generation
+
+        password = make(slug, old)
+
+        with self._lock:
+            if password is not None and generation == self._generation:
+                self._cache.put(key, (bytearray(password),))
+        return password
+
+    def clear(self):
+        """Evict all entries."""
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+
+    def stats(self):
+        """Returns: A dict of the size, entries, hits and misses."""
+        with self._lock:
+            return {
+                "size": self.size,
+                "entries": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class Session(object):
+    """A master in use, its intermediate and the passwords made with it.
+
+    Sessions are separate from each other, so one process can use several
+    masters at once. Safe to call from many threads at once.
+
+    Args:
+        lifetime: Seconds after use_master to forget the master, or None
+            to keep it until forget_master.
+        password_cache: The PasswordCache to use, defaults to a new one.
+        clock: Time source in seconds.
+    """
+    def __init__(self, lifetime=None, password_cache=None, clock=time.time):
+        self.lifetime = lifetime
+        if password_cache is None:
+            password_cache = PasswordCache(clock=clock)
+        self.passwords = password_cache
+        self._clock = clock
+        # Guards the fields below.
+        self._lock = threading.Lock()
+        self._master = None
+        self._intermediate = None
+        self._expiry = None
+
+    def use_master(self, master_plaintext, use_bcrypt=False):
+        # Slow, so do it without the lock.
+        if use_bcrypt:
+            intermediate = alg.make_intermediate(master_plaintext)
+        else:
+            intermediate = master_plaintext
+        with self._lock:
+            self._master = master_plaintext
+            self._intermediate = intermediate
+            if self.lifetime is None:
+                self._expiry = None
+            else:
+                self._expiry = self._clock() + self.lifetime
+            self.passwords.clear()
+
+    def forget_master(self):
+        with self._lock:
+            self._forget()
+
+    def is_ready(self):
+        """Return whether there is a master/intermediate stored."""
+        master, intermediate = self._credentials()
+        return (master != None) or (intermediate != None)
+
+    def is_correct_master(self, password):
+        """ Returns True if the password matches the stored master, else False. """
+        master, _ = self._credentials()
+        if master:
+            return master == password
+        return _matches_stored_master(password)
+
+    def make_password(self, slug, old):
+        """
+        Turns the password + slug into a 20 character password.
+        The password is_good_pass and is deterministic.
+        Recent passwords are remembered in self.passwords.
+        """
+        return self.passwords.get_or_make(slug, old, self._make_password_uncached)
+
+    def iter_passwords(self, slugs, old):
+        """
+        Makes passwords for a stream of slugs in parallel, like make_password.
+
+        Yields: The passwords in the same order as slugs.
+        """
+        return alg.iter_site_passwords(self._need_intermediate(), slugs, old=old)
+
+    def _make_password_uncached(self, slug, old):
+        return alg.make_site_password(self._need_intermediate(), slug, old=old)
+
+    def _need_intermediate(self):
+        _, intermediate = self._credentials()
+        if not intermediate:
+            raise Exception("Cannot make password without an intermediate pw.")
+        return intermediate
+
+    def _credentials(self):
+        """Returns: (master, intermediate), forgetting them once expired."""
+        with self._lock:
+            if self._expiry is not None and self._expiry <= self._clock():
+                self._forget()
+            return self._master, self._intermediate
+
+    def _forget(self):
+        self._master = None
+        self._intermediate = None
+        self._expiry = None
+        self.passwords.clear()
+
+
+# The session used by the module functions.
+default_session = Session()
 
 def use_master(master_plaintext, use_bcrypt=False):
-    global session_master
-    global session_intermediate
-    session_master = master_plaintext
-    if use_bcrypt:
-        session_intermediate = alg.make_intermediate(session_master)
-    else:
-        session_intermediate = session_master
+    default_session.use_master(master_plaintext, use_bcrypt)
 
 def forget_master():
-    global session_master
-    global session_intermediate
-    session_master = None
-    session_intermediate = None
+    default_session.forget_master()
 
 def is_ready():
     """Return whether there is a master/intermediate stored."""
-    return (session_master != None) or (session_intermediate != None)
+    return default_session.is_ready()
 
 def read_stored_master():
     """
     Gets the stored component of the master saved on disk at MASTER_PW_PATH.
     If that file doesn't exist, returns None.
+
+    The contents are cached and only read again once the file changes.
     """
-    return open(MASTER_PW_PATH, 'r').read() if os.path.exists(MASTER_PW_PATH) else None
+    global _stored_master_cache
+    try:
+        st = os.stat(MASTER_PW_PATH)
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            _stored_master_cache = None
+            return None
+        raise
+    key = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+    cache = _stored_master_cache
+    if cache is None or cache[0] != key:
+        with open(MASTER_PW_PATH, 'r') as f:
+            cache = _stored_master_cache = (key, f.read())
+    return cache[1]
 
 def store_master(master_plaintext):
     """Safely stores a derivation of the master to MASTER_PW_PATH for checking against."""
+    global _stored_master_cache
+    _stored_master_cache = None
     _mkdir_p(MASTER_PW_DIR)
     with os.fdopen(os.open(MASTER_PW_PATH, os.O_WRONLY | os.O_CREAT, 0600), 'w') as f:
         f.write(alg.make_storeable(master_plaintext))
 
 def is_correct_master(password):
     """ Returns True if the password matches the stored master, else False. """
-    global session_master
-    if session_master:
-        return session_master == password
-    stored_component = read_stored_master()
-    if (stored_component is not None
-        and alg.check_stored(password, stored_component)):
-        return True
-    return False
+    return default_session.is_correct_master(password)
 
 def make_password(slug, old):
     """
     Turns the password + slug into a 20 character password.
     The password is_good_pass and is deterministic.
     """
-    if not session_intermediate:
-        raise Exception("Cannot make password without an intermediate pw.")
-    return alg.make_site_password(session_intermediate, slug, old=old)
+    return default_session.make_password(slug, old)
+
+def iter_passwords(slugs, old):
+    """
+    Makes passwords for a stream of slugs in parallel, like make_password.
+
+    Yields: The passwords in the same order as slugs.
+    """
+    return default_session.iter_passwords(slugs, old)
+
+def _matches_stored_master(password):
+    stored_component = read_stored_master()
+    if (stored_component is not None
+        and alg.check_stored(password, stored_component)):
+        return True
+    return False
 
 def _mkdir_p(path):
     try:
@@ -1,53 +1,174 @@
+import os
+import re
 import subprocess
 
+# Characters which have to be percent-escaped in Assuan lines.
+_ESCAPE_RE = re.compile(r"[%\r\n]")
+_UNESCAPE_RE = re.compile(r"%([0-9A-Fa-f]{2})")
+
 class PinEntryException(Exception):
     """Error while getting pin entry."""
 
-def get_pin(description="", prompt="", errormsg=""):
+class PinEntry(object):
+    """A pinentry process which can be asked for pins again and again.
+
+    The same process, and so the same window, is used for every get_pin
+    until close. Commands are sent and responses parsed one at a time.
+
+    Args:
+        command: The pinentry program to run.
+
+    Raises:
+        PinEntryException if pinentry can't be started.
+    """
+    def __init__(self, command="pinentry"):
+        try:
+            with open(os.devnull, "r+b") as devnull:
+                self._process = subprocess.Popen([command],
+                                                 stdin=subprocess.PIPE,
+                                                 stdout=subprocess.PIPE,
+                                                 stderr=devnull)
+        except OSError:
+            # Could not launch pinentry.
+            raise PinEntryException("Could not launch pinentry")
+        try:
+            # Greeting.
+            self._read_response()
+            try:
+                self._command("OPTION", "grab")
+            except _AssuanError:
+                # Not every pinentry knows every option.
+                pass
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_pin(self, description="", prompt="", errormsg=""):
+        """Ask the user for a password.
+
+        Return value:
+            User password as a string. Could be empty.
+            None if the user pressed cancel or pinentry could not ask.
+
+        Raises:
+            PinEntryException if something went wrong communicating with pinentry.
+        """
+        self._command("SETDESC", description)
+        self._command("SETPROMPT", prompt)
+        if errormsg:
+            self._command("SETERROR", errormsg)
+        try:
+            return self._command("GETPIN")
+        except _AssuanError:
+            # Canceled, or pinentry could not ask (no display, timeout...).
+            # Either way this prompt failed, but pinentry itself works.
+            return None
+
+    def close(self):
+        """Say goodbye to pinentry and wait for it to exit."""
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.write("BYE\n")
+                self._process.stdin.flush()
+            except IOError:
+                pass
+        try:
+            self._process.stdin.close()
+        except IOError:
+            pass
+        self._process.stdout.close()
+        self._process.wait()
+
+    def _command(self, name, arg=None):
+        """Send a command and read its response.
+
+        Returns: The data sent back or "".
+        """
+        line = name if arg is None else "{} {}".format(name, _escape(arg))
+        try:
+            self._process.stdin.write(line + "\n")
+            self._process.stdin.flush()
+        except IOError:
+            raise PinEntryException("pinentry exited.")
+        return self._read_response()
+
+    def _read_response(self):
+        """Read lines up to the OK or ERR which ends a response.
+
+        Returns: The concatenated, decoded D lines.
+
+        Raises:
+            _AssuanError on ERR.
+        """
+        data = []
+        while True:
+            line = self._process.stdout.readline()
+            if not line.endswith("\n"):
+                raise PinEntryException("Unexpected pinentry process output.")
+            line = line[:-1]
+            if line == "OK" or line.startswith("OK "):
+                return "".join(data)
+            if line.startswith("D "):
+                data.append(_unescape(line[2:]))
+            elif line.startswith("ERR "):
+                code, _, message = line[4:].partition(" ")
+                try:
+                    code = int(code)
+                except ValueError:
+                    raise PinEntryException("Unexpected pinentry process output.")
+                raise _AssuanError(code, message)
+            elif line.startswith("S ") or line.startswith("#") or line == "":
+                # Status and comment lines.
+                pass
+            else:
+                raise PinEntryException("Unexpected pinentry process output.")
+
+class _AssuanError(PinEntryException):
+    def __init__(self, code, message):
+        super(_AssuanError, self).__init__(code, message)
+        self.code = code
+        self.message = message
+
+def get_pin(description="", prompt="", errormsg="", command="pinentry"):
     """Run pinentry to get a password from the user.
 
     Return value:
         User password as a string. Could be empty.
-        None if the user pressed cancel.
+        None if the user pressed cancel or pinentry could not ask.
+
+    Raises:
+        PinEntryException if something went wrong communicating with pinentry.
+    """
+    with PinEntry(command) as entry:
+        return entry.get_pin(description, prompt, errormsg)
+
+def get_pin_until(is_correct, description="", prompt="", errormsg="",
+                  command="pinentry"):
+    """Ask for a password until is_correct(password), in one pinentry.
+
+    errormsg is shown after each wrong password.
+
+    Return value:
+        The correct password or None if the user pressed cancel or
+        pinentry could not ask.
 
     Raises:
         PinEntryException if something went wrong communicating with pinentry.
     """
-    try:
-        # Run pinentry, ignoring stderr.
-        pinentry = subprocess.Popen(["pinentry"],
-                                    stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-    except OSError:
-        # Could not launch pinentry.
-        raise PinEntryException("Could not launch pinentry")
-
-    commands = ""
-    commands += "SETDESC {}\n".format(description)
-    commands += "SETPROMPT {}\n".format(prompt)
-    commands += "SETERROR {}\n".format(errormsg)
-    commands += "OPTION grab\n"
-    commands += "GETPIN\n"
-    commands += "BYE\n"
-
-    output, _ = pinentry.communicate(input=commands)
-    output_lines = output.split("\n")
-
-    # Verify output.
-    if len(output_lines) < 8:
-        raise PinEntryException("Unexpected pinentry process output.")
-
-    xline = output_lines[-4]
-    yline = output_lines[-3]
-    if xline[:2] == "D ":
-        # User entered valid input.
-        return xline[2:].replace("%25", "%")
-    elif yline[:3] == "ERR":
-        # User cancelled.
-        return None
-    elif xline == "OK":
-        # User entered empty string.
-        return ""
-    else:
-        raise PinEntryException("Unexpected pinentry process output.")
+    with PinEntry(command) as entry:
+        pw = entry.get_pin(description, prompt)
+        while pw is not None and not is_correct(pw):
+            pw = entry.get_pin(description, prompt, errormsg)
+        return pw
+
+def _escape(text):
+    return _ESCAPE_RE.sub(lambda m: "%{:02X}".format(ord(m.group())), text)
+
+def _unescape(text):
+    return _UNESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)), text)
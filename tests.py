@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 """
 Usage:
-    tests.py
-    tests.py --find <seed> <rerolls> [<count>]
+    tests.py [--check-asserts]
+    tests.py --find <seed> <rerolls> [<count>] [options]
+
+Options:
+    --check-asserts   Check fast paths against reference implementations.
+    --workers=<n>     Number of processes to search with, defaults to CPUs.
+    --out=<file>      Append found vectors to a file, e.g. vectors.jsonl.
 """
 from docopt import docopt
 import unittest
@@ -11,7 +16,28 @@ import bcrypt
 import alg
 import binascii
 import hmac
+import imp
 import hashlib
+import agent
+import hashpasslib
+import agent_client
+import agent_protocol
+import os
+import shutil
+import socket
+import StringIO
+import tempfile
+import subprocess
+import distutils.spawn
+import json
+import logging
+import threading
+import time
+import vectors
+import bench
+import clipboard
+import ttlcache
+import pinentry
 
 class TestHashPassAlg(unittest.TestCase):
     def setUp(self):
@@ -32,11 +58,42 @@ class TestHashPassAlg(unittest.TestCase):
         with self.assertRaises(Exception):
             alg.make_intermediate("x" * 73)
 
+    def test_make_intermediates(self):
+        masters = ["1234", "super secret", "blowfish", "1234"]
+        for workers in (1, 2, None):
+            self.assertEqual(alg.make_intermediates(masters, workers=workers),
+                             map(alg.make_intermediate, masters))
+        self.assertEqual(alg.make_intermediates([]), [])
+
+    def test_make_intermediates_too_long(self):
+        masters = ["1234", "x" * 73, "super secret"]
+        with self.assertRaises(Exception):
+            alg.make_intermediates(masters, workers=2)
+        results = alg.make_intermediates(masters, workers=2,
+                                         return_exceptions=True)
+        self.assertEqual(results[0], self.intermediates[0])
+        self.assertIsInstance(results[1], Exception)
+        self.assertEqual(results[2], self.intermediates[1])
+
     def test_is_good_pass(self):
         self.assertTrue(alg.is_good_pass("a4#aaaaaaaaaaaaaaaaa"))
         self.assertTrue(alg.is_good_pass("oooo6o#ooaaaaaaaaaaa"))
         self.assertFalse(alg.is_good_pass(""))
         self.assertFalse(alg.is_good_pass("oeuoeuOOO2343"))
+        self.assertFalse(alg.is_good_pass("aaaaaaaaaaaaaaaaaaaa"))
+        self.assertFalse(alg.is_good_pass("a4aaaaaaaaaaaaaaaaaa"))
+        self.assertFalse(alg.is_good_pass("a#aaaaaaaaaaaaaaaaa!"))
+        self.assertFalse(alg.is_good_pass("4########\xff\x00iIlOZ012!"))
+        self.assertTrue(alg.is_good_pass("aaaaaaaaaaaaaaaaaa4#"))
+
+    def test_is_good_indices(self):
+        charset = alg.LETTERS + alg.NUMBERS + alg.SYMBOLS
+        for password in ["a4#aaaaaaaaaaaaaaaaa", "aaaaaaaaaaaaaaaaaaaa",
+                         "a4aaaaaaaaaaaaaaaaaa", "V=tT8TuMj4YRa3=6}K(J",
+                         "a4#aaaa"]:
+            indices = [charset.index(c) for c in password]
+            self.assertEqual(alg.is_good_pass(password),
+                             alg.is_good_indices(indices))
 
     def test_make_storeable(self):
         secret = "abcdef"
@@ -55,6 +112,15 @@ class TestHashPassAlg(unittest.TestCase):
         self.assertEqual(alg._bytes_to_pw_chars([255, 255, 255]), "????")
         self.assertEqual(alg._bytes_to_pw_chars([4,32,196]), "bcde")
 
+    def test_encode_candidate(self):
+        self.assertEqual(alg._encode_candidate("\x00" * 15), "a" * 20)
+        self.assertEqual(alg._encode_candidate("\xff" * 15), "?" * 20)
+        for i in xrange(64):
+            hashed_string = hashlib.sha256(str(i)).digest()
+            for bytez in (hashed_string[:15], hashed_string[15:30]):
+                self.assertEqual(alg._encode_candidate(bytez),
+                    alg._bytes_to_password_candidate(map(ord, bytez)))
+
     def test_hmac(self):
         secret = binascii.a2b_hex("4a656665")
         data = binascii.a2b_hex("7768617420646f2079612077616e7420666f72206e6f7468696e673f")
@@ -88,6 +154,56 @@ class TestHashPassAlg(unittest.TestCase):
         self._test_site(5, self.intermediates[0], "rhythm30362", "?wn7SQytbo@v*+Q*sm#3")
         self._test_site(6, self.intermediates[0], "rhythm353402", "k@4J*sQ}YpY)bFNw53Fz")
 
+    def test_make_site_passwords(self):
+        slugs = ["rhythm0", "rhythm1", "rhythm354", "rhythm0", ""]
+        for intermediate in self.intermediates:
+            self.assertEqual(
+                alg.make_site_passwords(intermediate, slugs),
+                [alg.make_site_password(intermediate, slug, old=False)
+                 for slug in slugs])
+            self.assertEqual(
+                alg.make_site_passwords(intermediate, slugs, old=True),
+                [alg.make_site_password(intermediate, slug, old=True)
+                 for slug in slugs])
+        self.assertEqual(alg.make_site_passwords(self.intermediates[0], []), [])
+
+    def test_iter_site_passwords(self):
+        intermediate = self.intermediates[0]
+        slugs = ["rhythm%d" % i for i in xrange(23)]
+        for old in [False, True]:
+            expected = alg.make_site_passwords(intermediate, slugs, old=old)
+            for workers in [1, 2]:
+                passwords = alg.iter_site_passwords(
+                    intermediate, iter(slugs), old=old, workers=workers,
+                    chunk_size=5)
+                self.assertEqual(list(passwords), expected)
+        self.assertEqual(list(alg.iter_site_passwords(intermediate, [], workers=2)), [])
+
+    def test_new_hash_keyed(self):
+        for key in ["Jefe", "", "k" * 64, "\xaa" * 131]:
+            keyed = alg._new_hasher(key)
+            for data in ["what do ya want for nothing?", "", "what"]:
+                self.assertEqual(alg._new_hash(key, data),
+                                 alg._new_hash_keyed(keyed, data))
+        keyed = alg._new_hasher("Jefe")
+        prefixed = alg._new_hash_prefixed(keyed, "what do ya ")
+        for data in ["want for nothing?", ""]:
+            self.assertEqual(alg._new_hash("Jefe", "what do ya " + data),
+                             alg._new_hash_keyed(prefixed, data))
+
+    def test_vectors(self):
+        """Vectors found by --find."""
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "vectors.jsonl")
+        with open(path) as f:
+            found = vectors.load(f)
+        self.assertTrue(found)
+        for vector in found:
+            self.assertEqual(
+                alg.make_site_password_new(vector["intermediate"],
+                                           vector["slug"], out_extra=True),
+                (0, vector["rerolls"], vector["password"]))
+
 
 class TestHashPassAlgOld(unittest.TestCase):
     def _test_site(self, rerolls, master, slug, result):
@@ -112,6 +228,15 @@ class TestHashPassAlgOld(unittest.TestCase):
                     "$2b$13$X5A4.IjQghzyTGwc0wgRrecUMeNiIgapq6zxM07dr3UDDdHUYWLTC",
                     "xyz", old=True))
 
+    def test_out_extra(self):
+        self.assertEqual(alg.make_site_password_old("a", "b", out_extra=True),
+                         (0, "P4{tRc6X3q}5)bCw}su="))
+        self.assertEqual(alg.make_site_password_old("a", "sportsball", out_extra=True),
+                         (1, "C}Kzk*)6(CbR}sM5PxuK"))
+        self.assertEqual(
+            alg.make_site_password_old("S1R1yyV1i0", "ZKyePZecAO", out_extra=True),
+            (7, "o}JgLvJv*4cmw{rcAXBo"))
+
     def test_make_site_password_more(self):
         self._test_site(0, "wwsx6kolKO", "Ckf2oCe18I", "jzebYcmJ}+8b5rye{9Dn")
         self._test_site(0, "ld55r6WDwQ", "GC5S79GqSO", "6xMrd#LETG{HX7R=4T#m")
@@ -136,6 +261,1277 @@ class TestHashPassAlgOld(unittest.TestCase):
         self._test_site(7, "S1R1yyV1i0", "ZKyePZecAO", "o}JgLvJv*4cmw{rcAXBo")
 
 
+@unittest.skipUnless(distutils.spawn.find_executable("python3"),
+                     "python3 is needed for alg3")
+class TestAlg3(unittest.TestCase):
+    """alg3 under python3 against alg on the vectors above."""
+    def setUp(self):
+        self.intermediates = [
+            "$2y$10$w1dpoPu1duVEV4rnZPAkLe8kxqbSe4xmE4jVqL4IcwVLWluqZNI3G",
+            "$2y$10$w1dpoPu1duVEV4rnZPAkLea0PzJXKXtAHtHZ60MWk6pk1GH1uKpSe",
+            "$2y$10$w1dpoPu1duVEV4rnZPAkLefQ9jBvhg/MM6m/oTFbWLBq0R0bhwiVW",
+        ]
+        self.slugs = ["rhythm0", "rhythm1", "rhythm5", "rhythm151", "rhythm354",
+                      "rhythm2435", "rhythm30362", "rhythm353402", "", "\xff\n"]
+        self.slugs += ["rhythm{}".format(i) for i in xrange(200)]
+        self.old_pairs = [
+            ("a", "b"), ("batterystapler", "sportsball"), ("a", "sportsball"),
+            ("$2b$13$X5A4.IjQghzyTGwc0wgRrecUMeNiIgapq6zxM07dr3UDDdHUYWLTC", "xyz"),
+            ("wwsx6kolKO", "Ckf2oCe18I"), ("ld55r6WDwQ", "GC5S79GqSO"),
+            ("efc2IqOijl", "aPu9wXGvAP"), ("B3u9mDOEeS", "nEi2IWIV0w"),
+            ("JP8EUAzBnR", "zrSqXm2mGG"), ("FpJSv3ihkH", "TgaTRyIkDe"),
+            ("vFWLes9UiF", "PuVVQfm2po"), ("rl7XJ8BAGN", "5RMHUhtPwC"),
+            ("p6SMCnGvk7", "CNY4p2xRzE"), ("PXDeRAprND", "PWk8Z4l11M"),
+            ("cpp4BigYOS", "iQ0b5dpaK7"), ("lALmhk7BUd", "KVSVshAKnT"),
+            ("fPmAEDLRb5", "jvnsGGw6sJ"), ("O4MhHSyaKo", "5Jf9O2SK0E"),
+            ("EnVAR9wmHZ", "IRztX5yKim"), ("Dqwz1XXJjf", "1b5Uaj47jx"),
+            ("L7UnQr4EgO", "necPJcqE6e"), ("nVoKbxmzuA", "lmOMsSXZ5A"),
+            ("iSqlhru8op", "gJiWkK4JcO"), ("d9bqrOq7mN", "0ZSK8Ij1RT"),
+            ("S1R1yyV1i0", "ZKyePZecAO")]
+        self.old_pairs += [(intermediate, slug) for intermediate in self.intermediates
+                           for slug in self.slugs]
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "vectors.jsonl")
+        with open(path) as f:
+            self.vectors = vectors.load(f)
+
+    def run_alg3(self, request):
+        proc = subprocess.Popen(["python3", "-B", "-c", _ALG3_SCRIPT],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        out, _ = proc.communicate(json.dumps(request))
+        self.assertEqual(proc.returncode, 0)
+        return json.loads(out)
+
+    def test_matches_alg(self):
+        new_pairs = [(intermediate, slug) for intermediate in self.intermediates
+                     for slug in self.slugs]
+        new_pairs += [(vector["intermediate"], vector["slug"])
+                      for vector in self.vectors]
+        results = self.run_alg3({
+            "new": [map(_latin1, pair) for pair in new_pairs],
+            "old": [map(_latin1, pair) for pair in self.old_pairs],
+        })
+        self.assertEqual(len(results["new"]), len(new_pairs))
+        for pair, result in zip(new_pairs, results["new"]):
+            self.assertEqual(
+                result, list(alg.make_site_password_new(*pair, out_extra=True)), pair)
+        self.assertEqual(len(results["old"]), len(self.old_pairs))
+        for pair, result in zip(self.old_pairs, results["old"]):
+            self.assertEqual(
+                result, list(alg.make_site_password_old(*pair, out_extra=True)), pair)
+        for vector, result in zip(self.vectors, results["new"][-len(self.vectors):]):
+            self.assertEqual(result, [0, vector["rerolls"], vector["password"]])
+        self.assertEqual(results["hmac"].encode("latin-1"), binascii.a2b_hex(
+            "5bdcc146bf60754e6a042426089575c75a003f089d2739839dec58b964ec3843"))
+
+    def test_constants(self):
+        names = ["REUSED_BCRYPT_SALT", "BCRYPT_MAX_LENGTH", "REROLL_LIMIT",
+                 "LETTERS", "NUMBERS", "SYMBOLS", "CHARSET"]
+        results = self.run_alg3({"constants": names})
+        for name in names:
+            self.assertEqual(results["constants"][name], getattr(alg, name), name)
+
+    def test_make_intermediate(self):
+        masters = ["1234", "super secret", "blowfish", "x" * 72, "x" * 73]
+        results = self.run_alg3({"masters": masters})
+        # Checked before bcrypt is imported.
+        self.assertEqual(results["masters"][-1], "Exception")
+        if not results["bcrypt"]:
+            self.skipTest("python3 has no bcrypt")
+        self.assertEqual(results["masters"][:-1],
+                         [alg.make_intermediate(master) for master in masters[:-1]])
+
+
+def _latin1(text):
+    """Pass bytes through json unchanged, see _ALG3_SCRIPT."""
+    return text.decode("latin-1")
+
+
+# Runs alg3 under python3. Reads a JSON request from stdin and writes
+# the results as JSON, strings are bytes decoded as latin-1.
+_ALG3_SCRIPT = """
+import binascii, json, sys
+import alg3
+
+def latin1(value):
+    if isinstance(value, bytes):
+        return value.decode("latin-1")
+    if isinstance(value, tuple):
+        return [latin1(item) for item in value]
+    return value
+
+def intermediate_or_error(master):
+    try:
+        return latin1(alg3.make_intermediate(master.encode()))
+    except Exception as exc:
+        return type(exc).__name__
+
+request = json.load(sys.stdin)
+results = {}
+for name, fn in [("new", alg3.make_site_password_new),
+                 ("old", alg3.make_site_password_old)]:
+    results[name] = [
+        latin1(fn(intermediate.encode("latin-1"), slug.encode("latin-1"),
+                  out_extra=True))
+        for intermediate, slug in request.get(name, [])]
+results["hmac"] = latin1(alg3._new_hash(b"Jefe", b"what do ya want for nothing?"))
+results["constants"] = {name: latin1(getattr(alg3, name))
+                        for name in request.get("constants", [])}
+try:
+    import bcrypt
+    results["bcrypt"] = True
+except ImportError:
+    results["bcrypt"] = False
+results["masters"] = [intermediate_or_error(master)
+                      for master in request.get("masters", [])
+                      if results["bcrypt"] or len(master) > alg3.BCRYPT_MAX_LENGTH]
+json.dump(results, sys.stdout)
+"""
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = ttlcache.TTLCache(size=2, lifetime=60, clock=lambda: self.now)
+
+    def test_lru_eviction(self):
+        a = (bytearray("a"), None)
+        b = (bytearray("b"), bytearray("bb"))
+        self.cache.put("a", a)
+        self.cache.put("b", b)
+        self.assertIs(self.cache.get("a"), a)
+        self.cache.put("c", (bytearray("c"),))
+        self.assertNotIn("b", self.cache)
+        self.assertEqual(b, (bytearray(1), bytearray(2)))
+        self.assertEqual(a, (bytearray("a"), None))
+        self.assertEqual(len(self.cache), 2)
+
+    def test_replace_wipes(self):
+        a = (bytearray("a"),)
+        self.cache.put("a", a)
+        self.cache.put("a", (bytearray("A"),))
+        self.assertEqual(a, (bytearray(1),))
+        self.assertEqual(self.cache.get("a"), (bytearray("A"),))
+
+    def test_expiry(self):
+        a = (bytearray("a"),)
+        self.cache.put("a", a)
+        self.now += 30
+        self.cache.put("b", (bytearray("b"),))
+        self.now += 30
+        self.assertEqual(self.cache.expire(), 1)
+        self.assertEqual(a, (bytearray(1),))
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("b"))
+
+    def test_disabled(self):
+        cache = ttlcache.TTLCache(size=0, lifetime=60)
+        a = (bytearray("a"),)
+        cache.put("a", a)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(a, (bytearray(1),))
+
+
+class TestIntermediateCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = agent.IntermediateCache(
+            size=2, lifetime=60, clock=lambda: self.now)
+
+    def test_fingerprint(self):
+        fingerprint = self.cache.fingerprint("1234")
+        self.assertEqual(fingerprint, self.cache.fingerprint("1234"))
+        self.assertNotEqual(fingerprint, self.cache.fingerprint("12345"))
+        self.assertNotIn("1234", fingerprint)
+        other = agent.IntermediateCache()
+        self.assertNotEqual(fingerprint, other.fingerprint("1234"))
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", "intermediate a")
+        self.assertEqual(self.cache.get("a"), "intermediate a")
+        self.assertIn("a", self.cache)
+        self.assertNotIn("b", self.cache)
+
+    def test_lru_eviction(self):
+        self.cache.put("a", "intermediate a")
+        self.cache.put("b", "intermediate b")
+        buf_a = self.cache._cache._entries["a"][1][0]
+        buf_b = self.cache._cache._entries["b"][1][0]
+        # Use a so b is least recently used.
+        self.cache.get("a")
+        self.cache.put("c", "intermediate c")
+        self.assertEqual(len(self.cache), 2)
+        self.assertNotIn("b", self.cache)
+        self.assertEqual(buf_b, bytearray(len("intermediate b")))
+        self.assertEqual(buf_a, bytearray("intermediate a"))
+        self.assertEqual(self.cache.get("a"), "intermediate a")
+        self.assertEqual(self.cache.get("c"), "intermediate c")
+
+    def test_expiry(self):
+        self.cache.put("a", "intermediate a")
+        self.now += 30
+        self.cache.put("b", "intermediate b")
+        buf_a = self.cache._cache._entries["a"][1][0]
+        self.now += 31
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(buf_a, bytearray(len("intermediate a")))
+        self.assertEqual(self.cache.get("b"), "intermediate b")
+        self.now += 30
+        self.assertNotIn("b", self.cache)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_clear(self):
+        self.cache.put("a", "intermediate a")
+        buf_a = self.cache._cache._entries["a"][1][0]
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(buf_a, bytearray(len("intermediate a")))
+
+
+class TestPasswordCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.made = []
+        self.cache = hashpasslib.PasswordCache(size=2, lifetime=10,
+                                               clock=lambda: self.now)
+
+    def make(self, slug, old):
+        self.made.append((slug, old))
+        return "password for {} {}".format(slug, old)
+
+    def test_hits_and_eviction(self):
+        self.assertEqual(self.cache.get_or_make("a", False, self.make),
+                         "password for a False")
+        self.cache.get_or_make("a", True, self.make)
+        self.cache.get_or_make("a", False, self.make)
+        self.cache.get_or_make("b", False, self.make)
+        # ("a", True) was least recently used.
+        self.cache.get_or_make("a", True, self.make)
+        self.assertEqual(self.made, [("a", False), ("a", True), ("b", False),
+                                     ("a", True)])
+        self.assertEqual(self.cache.stats(),
+                         {"size": 2, "entries": 2, "hits": 1, "misses": 4})
+
+    def test_lifetime(self):
+        self.cache.get_or_make("a", False, self.make)
+        self.now = 9
+        self.cache.get_or_make("a", False, self.make)
+        self.now = 10
+        self.cache.get_or_make("a", False, self.make)
+        self.assertEqual(len(self.made), 2)
+
+    def test_clear_wipes(self):
+        self.cache.get_or_make("a", False, self.make)
+        buf = self.cache._cache._entries[("a", False)][1][0]
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(buf, bytearray(len("password for a False")))
+
+    def test_clear_while_making(self):
+        def make_and_clear(slug, old):
+            self.cache.clear()
+            return self.make(slug, old)
+        self.cache.get_or_make("a", False, make_and_clear)
+        self.assertEqual(len(self.cache), 0)
+        self.cache.get_or_make("a", False, self.make)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_disabled(self):
+        cache = hashpasslib.PasswordCache(size=0)
+        cache.get_or_make("a", False, self.make)
+        cache.get_or_make("a", False, self.make)
+        self.assertEqual(len(self.made), 2)
+
+    def test_session(self):
+        try:
+            hashpasslib.use_master("1234")
+            self.assertEqual(hashpasslib.make_password("b", old=True),
+                             alg.make_site_password("1234", "b", old=True))
+            hashpasslib.make_password("b", old=True)
+            self.assertEqual(len(hashpasslib.default_session.passwords), 1)
+            hashpasslib.use_master("abcd")
+            self.assertEqual(len(hashpasslib.default_session.passwords), 0)
+            self.assertEqual(hashpasslib.make_password("b", old=True),
+                             alg.make_site_password("abcd", "b", old=True))
+        finally:
+            hashpasslib.forget_master()
+        self.assertEqual(len(hashpasslib.default_session.passwords), 0)
+
+
+class TestSession(unittest.TestCase):
+    def test_sessions_are_separate(self):
+        a = hashpasslib.Session()
+        b = hashpasslib.Session()
+        a.use_master("1234")
+        self.assertTrue(a.is_ready())
+        self.assertFalse(b.is_ready())
+        self.assertFalse(hashpasslib.is_ready())
+        b.use_master("abcd")
+        self.assertEqual(a.make_password("x", old=True),
+                         alg.make_site_password("1234", "x", old=True))
+        self.assertEqual(b.make_password("x", old=True),
+                         alg.make_site_password("abcd", "x", old=True))
+        self.assertTrue(a.is_correct_master("1234"))
+        self.assertFalse(a.is_correct_master("abcd"))
+        a.forget_master()
+        self.assertFalse(a.is_ready())
+        self.assertEqual(len(a.passwords), 0)
+        self.assertEqual(len(b.passwords), 1)
+        with self.assertRaises(Exception):
+            a.make_password("x", old=True)
+
+    def test_lifetime(self):
+        now = [0]
+        session = hashpasslib.Session(lifetime=10, clock=lambda: now[0])
+        session.use_master("1234")
+        session.make_password("x", old=True)
+        now[0] = 9
+        self.assertTrue(session.is_ready())
+        now[0] = 10
+        self.assertFalse(session.is_ready())
+        self.assertEqual(len(session.passwords), 0)
+
+    def test_threads(self):
+        sessions = [hashpasslib.Session() for _ in xrange(4)]
+        for i, session in enumerate(sessions):
+            session.use_master("master{}".format(i))
+        slugs = ["rhythm{}".format(i) for i in xrange(20)]
+        results = {}
+        def run(i):
+            results[i] = [sessions[i % 4].make_password(slug, old=(i % 2 == 0))
+                          for slug in slugs]
+        threads = [threading.Thread(target=run, args=(i,)) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        for i in xrange(8):
+            self.assertEqual(results[i], alg.make_site_passwords(
+                "master{}".format(i % 4), slugs, old=(i % 2 == 0)))
+
+
+class TestStoredMaster(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self._paths = (hashpasslib.MASTER_PW_DIR, hashpasslib.MASTER_PW_PATH)
+        hashpasslib.MASTER_PW_DIR = os.path.join(self.dir, "hashpass/")
+        hashpasslib.MASTER_PW_PATH = hashpasslib.MASTER_PW_DIR + "password.bcrypt"
+        hashpasslib._stored_master_cache = None
+        self.opens = 0
+        def counting_open(*args):
+            self.opens += 1
+            return open(*args)
+        hashpasslib.open = counting_open
+
+    def tearDown(self):
+        del hashpasslib.open
+        hashpasslib.MASTER_PW_DIR, hashpasslib.MASTER_PW_PATH = self._paths
+        hashpasslib._stored_master_cache = None
+        shutil.rmtree(self.dir)
+
+    def test_read_missing(self):
+        self.assertIsNone(hashpasslib.read_stored_master())
+        self.assertFalse(hashpasslib.is_correct_master("1234"))
+        self.assertEqual(self.opens, 0)
+
+    def test_read_cached(self):
+        stored = alg.make_storeable("1234", rounds=4)
+        hashpasslib._mkdir_p(hashpasslib.MASTER_PW_DIR)
+        with open(hashpasslib.MASTER_PW_PATH, "w") as f:
+            f.write(stored)
+        self.assertEqual(hashpasslib.read_stored_master(), stored)
+        self.assertFalse(hashpasslib.is_correct_master("12345"))
+        self.assertFalse(hashpasslib.is_correct_master("123456"))
+        self.assertTrue(hashpasslib.is_correct_master("1234"))
+        self.assertEqual(self.opens, 1)
+
+        # Replacing the file is noticed.
+        restored = alg.make_storeable("abcd", rounds=4)
+        with open(hashpasslib.MASTER_PW_PATH + ".new", "w") as f:
+            f.write(restored)
+        os.rename(hashpasslib.MASTER_PW_PATH + ".new", hashpasslib.MASTER_PW_PATH)
+        self.assertEqual(hashpasslib.read_stored_master(), restored)
+        self.assertEqual(self.opens, 2)
+
+        os.remove(hashpasslib.MASTER_PW_PATH)
+        self.assertIsNone(hashpasslib.read_stored_master())
+
+
+class _FakeClipboardBackend(object):
+    def __init__(self):
+        self.text = ""
+        self.copies = 0
+        self.clears = 0
+        self.changed = threading.Event()
+
+    def copy(self, text):
+        self.text = text
+        self.copies += 1
+        self.changed.set()
+
+    def paste(self):
+        return self.text
+
+    def clear(self):
+        self.text = ""
+        self.clears += 1
+        self.changed.set()
+
+
+class TestClipboard(unittest.TestCase):
+    def setUp(self):
+        self.backend = _FakeClipboardBackend()
+        self.clipboard = clipboard.Clipboard(self.backend)
+
+    def tearDown(self):
+        self.clipboard.close()
+
+    def wait_for_clear(self):
+        while self.backend.clears == 0:
+            self.assertTrue(self.backend.changed.wait(5))
+            self.backend.changed.clear()
+
+    def test_clears(self):
+        self.clipboard.copy("secret", 0.01)
+        self.assertEqual(self.backend.text, "secret")
+        self.assertTrue(self.clipboard.pending())
+        self.wait_for_clear()
+        self.assertEqual(self.backend.text, "")
+        self.assertFalse(self.clipboard.pending())
+
+    def test_replace(self):
+        self.clipboard.copy("first", 0.01)
+        self.clipboard.copy("second", 60)
+        time.sleep(0.05)
+        self.assertEqual(self.backend.text, "second")
+        self.assertEqual(self.backend.clears, 0)
+        self.clipboard.copy("third", 0.01)
+        self.wait_for_clear()
+        self.assertEqual(self.backend.clears, 1)
+
+    def test_copied_elsewhere(self):
+        self.clipboard.copy("secret", 60)
+        self.backend.text = "something else"
+        self.assertFalse(clipboard.clear_if_unchanged(
+            self.backend, clipboard._digest("secret")))
+        self.assertEqual(self.backend.text, "something else")
+        self.assertTrue(clipboard.clear_if_unchanged(
+            self.backend, clipboard._digest("something else")))
+        self.assertEqual(self.backend.text, "")
+
+    def test_close(self):
+        self.clipboard.copy("secret", 60)
+        timer = self.clipboard._timer
+        self.clipboard.close()
+        self.assertFalse(timer.is_alive())
+        self.assertFalse(self.clipboard.pending())
+        self.assertEqual(self.backend.text, "secret")
+        self.assertEqual(self.backend.clears, 0)
+
+
+class TestPinEntry(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmpdir, "log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fake_pinentry(self, pins, errors={}):
+        """Make a pinentry which answers GETPINs with pins, None to cancel.
+
+        errors maps lines, or GREETING, to the ERR to answer them with.
+        """
+        path = os.path.join(self.tmpdir, "pinentry")
+        with open(path, "w") as f:
+            f.write("#!{}\n".format(sys.executable))
+            f.write(_FAKE_PINENTRY_SCRIPT.format(
+                log=self.log_path, pins=repr(json.dumps(pins)),
+                errors=repr(json.dumps(errors))))
+        os.chmod(path, 0700)
+        return path
+
+    def log(self):
+        with open(self.log_path) as f:
+            return f.read().splitlines()
+
+    def test_retries_in_one_process(self):
+        command = self.fake_pinentry(["wrong", "100%\nright", None])
+        with pinentry.PinEntry(command) as entry:
+            self.assertEqual(entry.get_pin("Desc", "Pw:"), "wrong")
+            self.assertEqual(entry.get_pin("Desc", "Pw:", "100% wrong\n"),
+                             "100%\nright")
+            self.assertIsNone(entry.get_pin("Desc", "Pw:"))
+        log = self.log()
+        self.assertEqual(log.count("START"), 1)
+        self.assertEqual(log.count("GETPIN"), 3)
+        self.assertIn("SETERROR 100%25 wrong%0A", log)
+        self.assertEqual(log[-2:], ["BYE", "EXIT"])
+
+    def test_get_pin_until(self):
+        command = self.fake_pinentry(["a", "b", "c"])
+        self.assertEqual(pinentry.get_pin_until(
+            lambda pw: pw == "b", "Desc", "Pw:", "Wrong.", command), "b")
+        log = self.log()
+        self.assertEqual(log.count("START"), 1)
+        self.assertEqual(log.count("SETERROR Wrong."), 1)
+        command = self.fake_pinentry([None])
+        self.assertIsNone(pinentry.get_pin_until(
+            lambda pw: True, command=command))
+
+    def test_unknown_option(self):
+        command = self.fake_pinentry(
+            ["pin"], {"OPTION grab": "ERR 83886254 Unknown option <Pinentry>"})
+        self.assertEqual(pinentry.get_pin("Desc", "Pw:", command=command), "pin")
+
+    def test_command_error(self):
+        command = self.fake_pinentry(["pin"], {"SETDESC Desc": "ERR 1 Nope"})
+        with self.assertRaises(pinentry.PinEntryException):
+            pinentry.get_pin_until(lambda pw: True, "Desc", command=command)
+        self.assertEqual(self.log()[-1], "EXIT")
+
+    def test_bad_greeting(self):
+        command = self.fake_pinentry([], {"GREETING": "ERR 1 Go away"})
+        with self.assertRaises(pinentry.PinEntryException):
+            pinentry.PinEntry(command)
+        # Not left running.
+        self.assertEqual(self.log()[-1], "EXIT")
+
+    def test_getpin_error(self):
+        command = self.fake_pinentry(
+            [], {"GETPIN": "ERR 83918950 Inappropriate ioctl for device"})
+        self.assertIsNone(pinentry.get_pin_until(lambda pw: True, command=command))
+
+    def test_agent_prompt_fails(self):
+        self.fake_pinentry(
+            [], {"GETPIN": "ERR 83918950 Inappropriate ioctl for device"})
+        path = os.environ["PATH"]
+        os.environ["PATH"] = self.tmpdir + os.pathsep + path
+        try:
+            a = _TestAgent()
+            res = a.process_message({"type": "get_password", "slug": "rhythm0"})
+        finally:
+            os.environ["PATH"] = path
+        self.assertEqual(res, {"error": "no master"})
+        # Only this prompt failed, the agent keeps running.
+        self.assertFalse(a.canceled)
+        self.assertEqual(a.exit_code, 0)
+        self.assertEqual(self.log().count("GETPIN"), 1)
+
+    def test_unescape(self):
+        self.assertEqual(pinentry._unescape("a%25b%0A%0dc%"), "a%b\n\rc%")
+        self.assertEqual(pinentry._unescape(pinentry._escape("%0A\r\n")),
+                         "%0A\r\n")
+
+    def test_missing(self):
+        with self.assertRaises(pinentry.PinEntryException):
+            pinentry.PinEntry(os.path.join(self.tmpdir, "missing"))
+
+
+# A pinentry which logs its commands and answers GETPINs from a list.
+_FAKE_PINENTRY_SCRIPT = """
+import json, sys
+pins = json.loads({pins})
+errors = json.loads({errors})
+log = open('{log}', 'a')
+def say(line):
+    sys.stdout.write(line + '\\n')
+    sys.stdout.flush()
+log.write('START\\n')
+say(errors.get('GREETING', 'OK Pleased to meet you'))
+for line in iter(sys.stdin.readline, ''):
+    line = line.rstrip('\\n')
+    log.write(line + '\\n')
+    log.flush()
+    if line in errors:
+        say(errors[line])
+    elif line == 'GETPIN':
+        pin = pins.pop(0)
+        if pin is None:
+            say('ERR 83886179 Operation cancelled <Pinentry>')
+            continue
+        pin = pin.replace('%', '%25').replace('\\n', '%0A')
+        say('S some status')
+        say('D ' + pin[:3])
+        say('D ' + pin[3:])
+        say('OK')
+    elif line == 'BYE':
+        break
+    else:
+        say('OK')
+log.write('EXIT\\n')
+log.flush()
+try:
+    say('OK closing connection')
+except IOError:
+    # The client need not wait for this.
+    pass
+"""
+
+
+def _load_script(name, path):
+    """Import a script which is not a module, without leaving bytecode."""
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        return imp.load_source(name, os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), path))
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+
+
+class _FakeLabel(object):
+    def __init__(self):
+        self.text = ""
+
+    def config(self, text):
+        self.text = text
+
+
+class _FakeVar(object):
+    def __init__(self):
+        self.value = ""
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+class TestGuiLogic(unittest.TestCase):
+    """HashPass without a display, the widgets it touches are faked."""
+    def setUp(self):
+        self.gui = _load_script("hashpass_gui", "hashpass-gui.py")
+        self.app = self.gui.HashPass.__new__(self.gui.HashPass)
+        self.app.label_clipboard = _FakeLabel()
+        self.app.entry_var = _FakeVar()
+        self.app.after = lambda ms, fn, *args: self.scheduled.append((fn, args))
+        self.app.no_saved_master = False
+        self.app.checking_master = False
+        self.app.asked_for_master = True
+        self.scheduled = []
+        # The GUI prints as it goes.
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def run_scheduled(self):
+        deadline = time.time() + 10
+        while self.scheduled and time.time() < deadline:
+            fn, args = self.scheduled.pop(0)
+            time.sleep(0.01)
+            fn(*args)
+        self.assertEqual(self.scheduled, [])
+
+    def test_master_too_long(self):
+        stored = "$2y$11$Gzhmkebfiz2OapRqu/zWSOH2Wa9uAsbb4Vd5q3iKBILsMRX8MBpQa"
+        self.gui.check_and_use_master = lambda master: alg.check_stored(master, stored)
+        self.app.entry_var.set("x" * 73)
+        self.app.on_press_enter()
+        self.run_scheduled()
+        self.assertFalse(self.app.checking_master)
+        self.assertTrue(self.app.asked_for_master)
+        self.assertIn("72 bytes", self.app.label_clipboard.text)
+        self.assertIn("Enter your master password.", self.app.label_clipboard.text)
+
+        # The master can be entered again.
+        self.gui.check_and_use_master = lambda master: True
+        self.app.ask_for_website = lambda keep_text=False: None
+        self.app.derivation_worker = self.gui.DerivationWorker(lambda slug: slug)
+        self.app.entry_var.set("blowfish")
+        self.app.on_press_enter()
+        self.run_scheduled()
+        self.assertFalse(self.app.checking_master)
+        self.assertFalse(self.app.asked_for_master)
+
+    def test_store_fails(self):
+        def store_master(master):
+            raise IOError("No space left on device")
+        self.app.no_saved_master = True
+        self.gui.hashpasslib = type("FakeHashpasslib", (), {
+            "store_master": staticmethod(store_master)})
+        self.app.entry_var.set("blowfish")
+        self.app.on_press_enter()
+        self.run_scheduled()
+        self.assertFalse(self.app.checking_master)
+        self.assertTrue(self.app.asked_for_master)
+        self.assertIn("No space left", self.app.label_clipboard.text)
+
+    def test_derivation_fails(self):
+        # Formatting a unicode slug into a str raises UnicodeEncodeError.
+        derive = lambda slug: "{}\n{}\n".format(slug, 0)
+        copied = []
+        self.app.clipboard_thread = type("FakeClipboardThread", (), {
+            "send_to_clipboard_at_some_point": staticmethod(copied.append)})
+        self.app.label_hash = _FakeLabel()
+        self.app.asked_for_master = False
+        self.app.polling_derivation = False
+        self.app.derivation_worker = self.gui.DerivationWorker(derive)
+        self.app.entry_var.set(u"caf\xe9")
+        self.app.on_change_entry()
+        self.run_scheduled()
+        self.assertFalse(self.app.derivation_worker.pending())
+        self.assertIn("Could not make a password", self.app.label_clipboard.text)
+        self.assertEqual(copied, [])
+
+        # The worker keeps going.
+        self.app.entry_var.set("cafe")
+        self.app.on_change_entry()
+        self.run_scheduled()
+        self.assertEqual(self.app.label_hash.text, "cafe\n0\n")
+        self.assertEqual(copied, ["cafe\n0\n"])
+
+
+class _RecordingHandler(logging.Handler):
+    """Keeps the log records it handles."""
+    def __init__(self, level):
+        super(_RecordingHandler, self).__init__(level)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class _TestAgent(agent._Agent):
+    """An agent which does not serve a socket."""
+    def _run(self):
+        pass
+
+
+class TestAgent(unittest.TestCase):
+    def setUp(self):
+        self.prompts = 0
+        self.answer = threading.Event()
+        self.master = "1234"
+        self._get_master_gui = agent.get_master_gui
+        agent.get_master_gui = self.fake_get_master_gui
+        self.agent = _TestAgent()
+
+    def tearDown(self):
+        agent.get_master_gui = self._get_master_gui
+
+    def fake_get_master_gui(self):
+        self.prompts += 1
+        self.answer.wait()
+        return self.master
+
+    def start(self, message, results):
+        thread = threading.Thread(
+            target=lambda: results.append(self.agent.process_message(message)))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_get_password(self):
+        self.answer.set()
+        res = self.agent.process_message({"type": "get_password", "slug": "rhythm0"})
+        self.assertEqual(res, {"password": "V=tT8TuMj4YRa3=6}K(J", "old": False})
+        res = self.agent.process_message({"type": "get_password", "slug": "rhythm1"})
+        self.assertEqual(res, {"password": "Y)@5Q{KSVtLs{zyYpC8U", "old": False})
+        res = self.agent.process_message(
+            {"type": "get_password", "slug": "b", "old": True})
+        self.assertEqual(res, {"password": alg.make_site_password("1234", "b", old=True),
+                               "old": True})
+        self.assertEqual(self.prompts, 1)
+
+    def test_get_passwords(self):
+        self.answer.set()
+        slugs = ["rhythm{}".format(i) for i in xrange(150)]
+        olds = [i % 3 == 0 for i in xrange(150)]
+        responses = list(self.agent.process_message(
+            {"type": "get_passwords", "slugs": slugs, "old": olds}))
+        self.assertEqual(responses[-1], {"count": 150})
+        self.assertTrue(all(res.pop("more") for res in responses[:-1]))
+        self.assertEqual([res["index"] for res in responses[:-1]], range(150))
+        intermediate = alg.make_intermediate("1234")
+        self.assertEqual(
+            [res["password"] for res in responses[:-1]],
+            [alg.make_site_password("1234" if old else intermediate, slug, old)
+             for slug, old in zip(slugs, olds)])
+        self.assertEqual(self.prompts, 1)
+
+    def test_get_passwords_invalid(self):
+        self.answer.set()
+        for message in [{"type": "get_passwords"},
+                        {"type": "get_passwords", "slugs": "abc"},
+                        {"type": "get_passwords", "slugs": ["a", 1]},
+                        {"type": "get_passwords", "slugs": ["a"], "old": [True, False]}]:
+            self.assertIsNone(self.agent.process_message(message))
+
+    def test_stats(self):
+        self.answer.set()
+        self.agent.process_message({"type": "get_password", "slug": "rhythm0"})
+        self.agent.process_message({"type": "get_password", "slug": "rhythm1"})
+        stats = self.agent.process_message({"type": "stats"})["stats"]
+        self.assertEqual(stats["counters"]["intermediate_cache.miss"], 1)
+        self.assertEqual(stats["counters"]["intermediate_cache.hit"], 1)
+        self.assertEqual(stats["latency"]["pinentry"]["count"], 1)
+        self.assertEqual(stats["latency"]["derive_intermediate"]["count"], 1)
+        self.assertEqual(stats["latency"]["derive_password"]["count"], 2)
+        self.assertEqual(stats["intermediate_cache_size"], 1)
+
+        self.agent.process_message({"type": "get_password", "slug": "rhythm0"})
+        stats = self.agent.process_message({"type": "stats"})["stats"]
+        self.assertEqual(stats["latency"]["derive_password"]["count"], 2)
+        self.assertEqual(stats["password_cache"]["hits"], 1)
+        self.assertEqual(stats["password_cache"]["misses"], 2)
+        self.assertEqual(stats["password_cache"]["entries"], 2)
+
+    def test_expired_master_forgets_passwords(self):
+        self.answer.set()
+        self.agent.process_message({"type": "get_password", "slug": "rhythm0"})
+        self.agent.intermediates.clear()
+        res = self.agent.process_message({"type": "get_password", "slug": "rhythm0"})
+        self.assertEqual(res, {"password": "V=tT8TuMj4YRa3=6}K(J", "old": False})
+        self.assertEqual(self.prompts, 2)
+
+    def test_canceled(self):
+        self.master = None
+        self.answer.set()
+        res = self.agent.process_message({"type": "get_password", "slug": "rhythm0"})
+        self.assertEqual(res, {"error": "no master"})
+        res = self.agent.process_message({"type": "get_passwords", "slugs": ["a"]})
+        self.assertEqual(list(res), [{"error": "no master"}])
+
+    def test_concurrent_requests_share_prompt(self):
+        results = []
+        threads = [self.start({"type": "get_password", "slug": "rhythm0"}, results)
+                   for _ in xrange(5)]
+        # Ping is answered while the prompt is up.
+        self.assertEqual(self.agent.process_message({"type": "ping"}),
+                         {"pong": "pong"})
+        self.assertEqual(results, [])
+        self.answer.set()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(results, [{"password": "V=tT8TuMj4YRa3=6}K(J", "old": False}] * 5)
+        self.assertEqual(self.prompts, 1)
+
+
+class TestAgentStats(unittest.TestCase):
+    def test_histogram(self):
+        histogram = agent.LatencyHistogram()
+        for us in [0.5, 3, 3, 100, 5000]:
+            histogram.record(us / 1e6)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["count"], 5)
+        self.assertAlmostEqual(snapshot["max_us"], 5000)
+        self.assertEqual(snapshot["buckets_us"],
+                         {"1": 1, "4": 2, "128": 1, "8192": 1})
+        self.assertEqual(snapshot["p50_us"], 4)
+        self.assertEqual(snapshot["p99_us"], 8192)
+        self.assertIsNone(agent.LatencyHistogram().snapshot()["p50_us"])
+
+    def test_stats(self):
+        now = [0.0]
+        stats = agent.AgentStats(clock=lambda: now[0])
+        stats.count("a")
+        stats.count("a", 2)
+        stats.adjust("g", 1)
+        stats.adjust("g", 1)
+        stats.adjust("g", -1)
+        with stats.timed("t"):
+            now[0] += 0.25
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot["counters"], {"a": 3})
+        self.assertEqual(snapshot["gauges"], {"g": {"current": 1, "peak": 2}})
+        self.assertEqual(snapshot["latency"]["t"]["count"], 1)
+        self.assertAlmostEqual(snapshot["latency"]["t"]["max_us"], 250000)
+        self.assertEqual(snapshot["uptime_s"], 0.25)
+
+
+class TestAgentProtocol(unittest.TestCase):
+    def test_line_reader(self):
+        a, b = socket.socketpair()
+        reader = agent_protocol.LineReader(a)
+        b.sendall('{"a": 1}\n{"b"')
+        self.assertEqual(reader.read_line(), '{"a": 1}')
+        b.sendall(': 2}\n\n{"c": 3}\n')
+        self.assertEqual(reader.read_line(), '{"b": 2}')
+        self.assertEqual(reader.read_line(), '')
+        self.assertEqual(reader.read_line(), '{"c": 3}')
+        b.sendall("x" * 10000)
+        b.close()
+        self.assertEqual(reader.read_line(), "x" * 10000)
+        self.assertIsNone(reader.read_line())
+        a.close()
+
+    def test_encode_decode(self):
+        message = {"type": "get_password", "slug": "a\nb", "id": 3}
+        line = agent_protocol.encode_message(message)
+        self.assertEqual(line.count("\n"), 1)
+        self.assertTrue(line.endswith("\n"))
+        self.assertEqual(agent_protocol.decode_message(line[:-1]), message)
+        with self.assertRaises(agent_protocol.ProtocolException):
+            agent_protocol.decode_message("{")
+
+
+class TestAgentClient(unittest.TestCase):
+    """Run an agent on a socket in a temporary directory and talk to it."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self._daemon_sock_path = agent_protocol.daemon_sock_path
+        self._get_master_gui = agent.get_master_gui
+        agent_protocol.daemon_sock_path = lambda: os.path.join(self.dir, "agent.sock")
+        agent.get_master_gui = lambda: "1234"
+        self._poll_interval = agent.ACCEPT_POLL_INTERVAL
+        agent.ACCEPT_POLL_INTERVAL = 0.01
+        self.start_agent()
+        self._session = agent_client._session
+        agent_client._session = agent_client.Session()
+
+    def tearDown(self):
+        self.stop_agent()
+        agent_client._session = self._session
+        agent_protocol.daemon_sock_path = self._daemon_sock_path
+        agent.get_master_gui = self._get_master_gui
+        agent.ACCEPT_POLL_INTERVAL = self._poll_interval
+        shutil.rmtree(self.dir)
+
+    def start_agent(self):
+        if os.path.exists(agent_protocol.daemon_sock_path()):
+            os.remove(agent_protocol.daemon_sock_path())
+        self.agent = _TestAgent()
+        self.thread = threading.Thread(target=agent._Agent._run,
+                                       args=(self.agent,))
+        self.thread.daemon = True
+        self.thread.start()
+        # Wait until it listens, the socket exists a moment before.
+        while True:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(agent_protocol.daemon_sock_path())
+                break
+            except socket.error:
+                time.sleep(0.01)
+            finally:
+                probe.close()
+
+    def stop_agent(self):
+        agent_client.send_shutdown()
+        self.thread.join(10)
+        agent_client._session.close()
+
+    def test_get_password(self):
+        self.assertTrue(agent_client.is_alive())
+        connection = agent_client._session._connection
+        self.assertEqual(agent_client.get_password("rhythm0"),
+                         "V=tT8TuMj4YRa3=6}K(J")
+        self.assertEqual(agent_client.get_password("rhythm1"),
+                         "Y)@5Q{KSVtLs{zyYpC8U")
+        self.assertIs(agent_client._session._connection, connection)
+
+    def test_get_passwords(self):
+        slugs = ["rhythm{}".format(i) for i in xrange(200)]
+        self.assertEqual(agent_client.get_passwords(slugs),
+                         alg.make_site_passwords(self.intermediate(), slugs))
+        self.assertEqual(agent_client.get_passwords(slugs[:3], old=True),
+                         alg.make_site_passwords("1234", slugs[:3], old=True))
+        self.assertEqual(agent_client.get_passwords([]), [])
+        # The connection is still in sync.
+        self.assertEqual(agent_client.get_password("rhythm0"),
+                         "V=tT8TuMj4YRa3=6}K(J")
+
+    def test_abandoned_stream(self):
+        slugs = ["rhythm{}".format(i) for i in xrange(200)]
+        stream = agent_client._session._stream_object(
+            {"type": "get_passwords", "slugs": slugs})
+        next(stream)
+        stream.close()
+        self.assertEqual(agent_client.get_password("rhythm0"),
+                         "V=tT8TuMj4YRa3=6}K(J")
+
+    def test_client_resets(self):
+        errors = _RecordingHandler(logging.ERROR)
+        logging.getLogger().addHandler(errors)
+        self.addCleanup(logging.getLogger().removeHandler, errors)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(agent_protocol.daemon_sock_path())
+        sock.sendall(agent_protocol.encode_message({
+            "type": "get_passwords", "id": 0,
+            "slugs": ["rhythm{}".format(i) for i in xrange(200)]}))
+        sock.recv(1)
+        # Hanging up with responses unread resets the connection.
+        sock.close()
+        deadline = time.time() + 10
+        while (agent_client.get_stats()["gauges"]["open_connections"]["current"] > 1
+               and time.time() < deadline):
+            time.sleep(0.01)
+        # Leaving early is no error.
+        self.assertEqual(errors.records, [])
+
+    def test_stats(self):
+        agent_client.get_password("rhythm0")
+        agent_client._session._send_object({"type": "nonsense"})
+        # Requests are recorded just after their response is sent, so ask
+        # until only this stats request is in flight.
+        deadline = time.time() + 10
+        polls = 0
+        while True:
+            stats = agent_client.get_stats()
+            polls += 1
+            if (stats["gauges"]["requests_in_flight"]["current"] == 1
+                    or time.time() > deadline):
+                break
+            time.sleep(0.01)
+        self.assertEqual(stats["counters"]["messages.get_password"], 1)
+        self.assertEqual(stats["counters"]["messages.invalid"], 1)
+        self.assertEqual(stats["counters"]["messages.stats"], polls)
+        self.assertEqual(stats["latency"]["request.get_password"]["count"], 1)
+        self.assertEqual(stats["gauges"]["open_connections"]["current"], 1)
+        self.assertEqual(stats["gauges"]["requests_in_flight"]["current"], 1)
+
+    def test_pipelined(self):
+        slugs = ["rhythm{}".format(i) for i in xrange(20)] + ["x" * 10000]
+        responses = agent_client._session._send_objects(
+            [{"type": "get_password", "slug": slug} for slug in slugs]
+            + [{"type": "nonsense"}])
+        self.assertEqual([res["password"] for res in responses[:-1]],
+                         alg.make_site_passwords(self.intermediate(), slugs))
+        self.assertEqual(responses[-1], {"error": "invalid message"})
+
+    def test_pipelined_requests_are_bounded(self):
+        self.addCleanup(setattr, agent, "REQUESTS_PER_CONNECTION",
+                        agent.REQUESTS_PER_CONNECTION)
+        agent.REQUESTS_PER_CONNECTION = 2
+        slugs = ["rhythm{}".format(i) for i in xrange(50)]
+        responses = agent_client._session._send_objects(
+            [{"type": "get_password", "slug": slug} for slug in slugs])
+        self.assertEqual([res["password"] for res in responses],
+                         alg.make_site_passwords(self.intermediate(), slugs))
+        stats = agent_client.get_stats()
+        self.assertLessEqual(stats["gauges"]["requests_in_flight"]["peak"], 2)
+
+    def test_threads_share_connection(self):
+        slugs = ["rhythm{}".format(i) for i in xrange(20)]
+        results = {}
+        def get(slug):
+            results[slug] = agent_client.get_password(slug)
+        threads = [threading.Thread(target=get, args=(slug,)) for slug in slugs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual([results[slug] for slug in slugs],
+                         alg.make_site_passwords(self.intermediate(), slugs))
+
+    def load_hashpass(self):
+        """Load the hashpass script with a ready local session to fall back to."""
+        hashpass = _load_script("hashpass", "hashpass")
+        hashpass.BATCH_CHUNK_SIZE = 4
+        self.addCleanup(setattr, hashpasslib, "default_session",
+                        hashpasslib.default_session)
+        hashpasslib.default_session = hashpasslib.Session()
+        hashpasslib.default_session.use_master("1234", use_bcrypt=True)
+        return hashpass
+
+    def test_batch(self):
+        hashpass = self.load_hashpass()
+        slugs = ["rhythm{}".format(i) for i in xrange(10)]
+        expected = zip(slugs, alg.make_site_passwords(self.intermediate(), slugs))
+        # With the agent up, neither alg nor bcrypt is imported.
+        hidden = dict((name, sys.modules.pop(name)) for name in ("alg", "bcrypt"))
+        sys.modules.update(dict.fromkeys(hidden))
+        try:
+            results = list(hashpass.make_passwords_maybe_agent(iter(slugs), True))
+        finally:
+            sys.modules.update(hidden)
+        self.assertEqual(results, expected)
+        stats = agent_client.get_stats()
+        self.assertEqual(stats["counters"]["messages.get_passwords"], 3)
+        # Nothing was made locally.
+        self.assertEqual(len(hashpasslib.default_session.passwords), 0)
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            hashpass.batch(iter(slugs[:2]), True, as_json=True)
+            hashpass.batch(iter(slugs[:1]), True, as_json=False)
+            out = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        lines = out.splitlines()
+        self.assertEqual([json.loads(line) for line in lines[:2]],
+                         [{"website": website, "password": password}
+                          for website, password in expected[:2]])
+        self.assertEqual(lines[2], "%s\t%s" % expected[0])
+
+    def test_batch_fallback(self):
+        hashpass = self.load_hashpass()
+        slugs = ["rhythm{}".format(i) for i in xrange(10)]
+        self.stop_agent()
+        self.assertEqual(
+            list(hashpass.make_passwords_maybe_agent(iter(slugs), True)),
+            zip(slugs, alg.make_site_passwords(self.intermediate(), slugs)))
+        # Forget that the agent was down.
+        agent_client._session.close()
+        self.start_agent()
+
+    def test_batch_agent_fails_partway(self):
+        hashpass = self.load_hashpass()
+        slugs = ["rhythm{}".format(i) for i in xrange(10)]
+        pairs = hashpass.make_passwords_maybe_agent(iter(slugs), True)
+        results = [next(pairs) for _ in xrange(hashpass.BATCH_CHUNK_SIZE)]
+        self.stop_agent()
+        results.extend(pairs)
+        self.assertEqual(
+            results, zip(slugs, alg.make_site_passwords(self.intermediate(), slugs)))
+        agent_client._session.close()
+        self.start_agent()
+
+    def test_reconnect(self):
+        self.assertEqual(agent_client.get_password("rhythm0"),
+                         "V=tT8TuMj4YRa3=6}K(J")
+        agent_client.send_shutdown()
+        self.thread.join(10)
+        # The agent's connections die with its process.
+        agent_client._session._connection._sock.shutdown(socket.SHUT_RDWR)
+        self.start_agent()
+        self.assertEqual(agent_client.get_password("rhythm0"),
+                         "V=tT8TuMj4YRa3=6}K(J")
+
+    def test_session_liveness(self):
+        session = agent_client.Session()
+        self.assertTrue(session.is_alive())
+        agent_client.send_shutdown()
+        self.thread.join(10)
+        # Still the answer from before.
+        self.assertTrue(session.is_alive())
+        session.close()
+        agent_client._session.close()
+
+        dead = agent_client.Session(os.path.join(self.dir, "missing.sock"))
+        self.assertFalse(dead.is_alive())
+        with self.assertRaises(agent_client.AgentClientException):
+            dead.ping()
+        self.start_agent()
+
+    def test_pool(self):
+        pool = agent_client.ConnectionPool(size=2)
+        slugs = ["rhythm{}".format(i) for i in xrange(20)]
+        results = {}
+        def get(slug):
+            results[slug] = pool.get_password(slug)
+        threads = [threading.Thread(target=get, args=(slug,)) for slug in slugs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual([results[slug] for slug in slugs],
+                         alg.make_site_passwords(self.intermediate(), slugs))
+        self.assertEqual(pool.get_passwords(slugs[:3]),
+                         alg.make_site_passwords(self.intermediate(), slugs[:3]))
+        stats = pool.stats()
+        self.assertLessEqual(stats["created"], 2)
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["open"], stats["idle"])
+        self.assertEqual(stats["created"] + stats["reused"], 21)
+        pool.close()
+        self.assertEqual(pool.stats()["open"], 0)
+
+    def test_pool_waits(self):
+        pool = agent_client.ConnectionPool(size=1, wait_timeout=0.05)
+        pool.ping()
+        connection, new = pool._get_connection()
+        self.assertFalse(new)
+        with self.assertRaises(agent_client.AgentClientException):
+            pool.ping()
+        pool._release_connection(connection)
+        self.assertEqual(pool.ping(), {"pong": "pong"})
+        self.assertEqual(pool.stats()["waits"], 1)
+        pool.close()
+
+    def test_pool_evicts_dead(self):
+        pool = agent_client.ConnectionPool(size=2, idle_check=0)
+        first, _ = pool._get_connection()
+        second, _ = pool._get_connection()
+        pool._release_connection(first)
+        pool._release_connection(second)
+        agent_client.send_shutdown()
+        self.thread.join(10)
+        agent_client._session.close()
+        # The agent's connections die with its process.
+        first._sock.shutdown(socket.SHUT_RDWR)
+        second._sock.shutdown(socket.SHUT_RDWR)
+        self.start_agent()
+        self.assertTrue(pool.is_alive())
+        stats = pool.stats()
+        self.assertEqual(stats["evicted"], 2)
+        self.assertEqual(stats["created"], 3)
+        self.assertEqual(stats["open"], 1)
+        pool.close()
+
+    @unittest.skipUnless(distutils.spawn.find_executable("python3"),
+                         "python3 is needed for the asyncio client")
+    def test_async_client(self):
+        slugs = ["rhythm{}".format(i) for i in xrange(20)]
+        out = subprocess.check_output(
+            ["python3", "-B", "-c", _ASYNC_CLIENT_SCRIPT,
+             agent_protocol.daemon_sock_path(),
+             os.path.join(self.dir, "missing.sock")] + slugs,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        results = json.loads(out)
+        passwords = alg.make_site_passwords(self.intermediate(), slugs)
+        self.assertEqual(results["concurrent"], passwords)
+        self.assertEqual(results["batch"], passwords)
+        self.assertEqual(results["old"], alg.make_site_password("1234", "b", old=True))
+        self.assertEqual(results["timeout"], "AgentClientException")
+        self.assertEqual(results["canceled"], "CancelledError")
+        self.assertEqual(results["after"], passwords[0])
+        self.assertEqual(results["missing"], "AgentClientException")
+
+    def intermediate(self):
+        return "$2y$10$w1dpoPu1duVEV4rnZPAkLe8kxqbSe4xmE4jVqL4IcwVLWluqZNI3G"
+
+
+# Drives the asyncio client under python3.
+# Usage: python3 -c _ASYNC_CLIENT_SCRIPT <sock> <missing sock> <slug>...
+_ASYNC_CLIENT_SCRIPT = """
+import asyncio, json, sys
+import agent_client
+
+async def error_name(coroutine):
+    try:
+        await coroutine
+    except (Exception, asyncio.CancelledError) as exc:
+        return type(exc).__name__
+
+async def main(path, missing, slugs):
+    results = {}
+    async with agent_client.AsyncAgentClient(path) as client:
+        results["concurrent"] = await asyncio.gather(
+            *[client.get_password(slug) for slug in slugs])
+        results["batch"] = await client.get_passwords(slugs)
+        results["old"] = await client.get_password("b", old=True)
+        results["timeout"] = await error_name(client.ping(timeout=0))
+        task = asyncio.ensure_future(client.get_password(slugs[0]))
+        await asyncio.sleep(0)
+        task.cancel()
+        results["canceled"] = await error_name(task)
+        results["after"] = await client.get_password(slugs[0])
+    results["missing"] = await error_name(
+        agent_client.AsyncAgentClient(missing).ping())
+    print(json.dumps(results))
+
+asyncio.run(main(sys.argv[1], sys.argv[2], sys.argv[3:]))
+"""
+
+
+class TestImports(unittest.TestCase):
+    def test_agent_fast_path_is_light(self):
+        for name, code in bench.IMPORT_TARGETS:
+            if name in ("agent_client", "hashpass"):
+                modules = bench.imported_modules(code)
+                self.assertIn("socket", modules)
+                for heavy in bench.HEAVY_MODULES:
+                    self.assertNotIn(heavy, modules, (name, heavy))
+
+
 if __name__ == "__main__":
     arguments = docopt(__doc__, version="1.0")
     if arguments["--find"]:
@@ -147,15 +1543,16 @@ if __name__ == "__main__":
         seed = arguments["<seed>"]
         rerolls = int(arguments["<rerolls>"])
         count = int(arguments["<count>"] or 1)
-        found = 0
-        for i in xrange(10000000):
-            if found >= count:
-                sys.exit(0)
-            slug = seed + str(i)
-            (generation, counter, result) = alg.make_site_password_new(
-                intermediate, slug, out_extra=True)
-            if counter == rerolls:
-                print rerolls, slug, result
-                found += 1
+        workers = int(arguments["--workers"]) if arguments["--workers"] else None
+        found = vectors.search(intermediate, seed, rerolls, count,
+                               workers=workers,
+                               progress=vectors.print_progress)
+        sys.stderr.write("\n")
+        for vector in found:
+            print vector["rerolls"], vector["slug"], vector["password"]
+        if arguments["--out"]:
+            with open(arguments["--out"], "a") as f:
+                vectors.dump(found, f)
     else:
-        unittest.main()
+        alg.CHECK_ASSERTS = arguments["--check-asserts"]
+        unittest.main(argv=sys.argv[:1])
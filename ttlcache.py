@@ -0,0 +1,86 @@
+"""
+Bounded cache of secrets which expire and are wiped when evicted.
+
+Used for the agent's intermediates and for site passwords.
+"""
+import collections
+import time
+
+
+class TTLCache(object):
+    """Bounded LRU cache whose entries expire lifetime seconds after being put.
+
+    Values are tuples of bytearrays or None. The bytearrays are zeroed
+    when their entry is evicted, replaced, expired or cleared.
+    Not thread safe on its own.
+
+    Args:
+        size: Maximum number of entries.
+        lifetime: Seconds to keep an entry.
+        clock: Time source in seconds.
+    """
+    def __init__(self, size, lifetime, clock=time.time):
+        self.size = size
+        self.lifetime = lifetime
+        self._clock = clock
+        # Map from key to (expiry time, value), least recently used first.
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Get a value and mark it as most recently used.
+
+        Returns: The value or None if it is not cached.
+        """
+        self.expire()
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        # Re-insert to mark as most recently used.
+        self._entries[key] = entry
+        return entry[1]
+
+    def put(self, key, value):
+        """Cache a value, evicting the least recently used if full."""
+        self.evict(key)
+        if self.size <= 0:
+            _wipe(value)
+            return
+        self._entries[key] = (self._clock() + self.lifetime, value)
+        while len(self._entries) > self.size:
+            self.evict(next(iter(self._entries)))
+
+    def expire(self):
+        """Evict all entries which have outlived their lifetime.
+
+        Returns: The number of entries evicted.
+        """
+        now = self._clock()
+        expired = [key for key, (expiry, _) in self._entries.iteritems()
+                   if expiry <= now]
+        for key in expired:
+            self.evict(key)
+        return len(expired)
+
+    def evict(self, key):
+        """Remove an entry if it is cached and wipe its value."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            _wipe(entry[1])
+
+    def clear(self):
+        """Evict all entries."""
+        for key in list(self._entries):
+            self.evict(key)
+
+    def __contains__(self, key):
+        self.expire()
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _wipe(value):
+    for buf in value:
+        if buf is not None:
+            buf[:] = "\0" * len(buf)
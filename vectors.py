@@ -0,0 +1,108 @@
+"""
+Search for and store test vectors of the new algorithm.
+
+A vector is a slug which needs a certain number of rerolls under an
+intermediate, along with its password. Vectors are stored as JSON lines
+which tests.py loads.
+"""
+import json
+import multiprocessing
+import sys
+import time
+import alg
+
+
+# Slugs checked by one task.
+BLOCK_SIZE = 10000
+
+# Largest slug suffix to try.
+SEARCH_LIMIT = 10000000
+
+
+def search(intermediate, seed, rerolls, count, workers=None,
+           limit=SEARCH_LIMIT, progress=None):
+    """Find slugs which take a certain number of rerolls.
+
+    Tries the slugs seed + "0", seed + "1", ... split into blocks across
+    a pool of processes, and stops once count are found. The vectors
+    found are the same as a search in order would find.
+
+    Args:
+        workers: Number of processes. Defaults to the number of CPUs.
+        progress: Called with (slugs checked, vectors found, seconds)
+            after each block.
+
+    Returns:
+        A list of vector dicts.
+    """
+    found = []
+    checked = 0
+    start = time.time()
+    blocks = ((intermediate, seed, rerolls, i, min(i + BLOCK_SIZE, limit))
+              for i in xrange(0, limit, BLOCK_SIZE))
+    pool = multiprocessing.Pool(workers)
+    try:
+        for block_found, block_checked in pool.imap(_search_block, blocks):
+            found.extend(block_found)
+            checked += block_checked
+            if progress is not None:
+                progress(checked, len(found), time.time() - start)
+            if len(found) >= count:
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+    return found[:count]
+
+
+def _search_block(args):
+    """Search one block of slugs.
+
+    Returns: A tuple of (vectors found, slugs checked).
+    """
+    intermediate, seed, rerolls, start, stop = args
+    found = []
+    for i in xrange(start, stop):
+        slug = seed + str(i)
+        (generation, counter, result) = alg.make_site_password_new(
+            intermediate, slug, out_extra=True)
+        if counter == rerolls:
+            found.append({
+                "intermediate": intermediate,
+                "slug": slug,
+                "rerolls": counter,
+                "password": result,
+            })
+    return found, stop - start
+
+
+def print_progress(checked, found, elapsed):
+    """Progress callback for search which writes to stderr."""
+    sys.stderr.write("\r{} slugs checked, {} found, {:.0f} slugs/s ".format(
+        checked, found, checked / elapsed if elapsed else 0))
+    sys.stderr.flush()
+
+
+def dump(vectors, f):
+    """Write vectors to a file as JSON lines."""
+    for vector in vectors:
+        f.write(json.dumps(vector, sort_keys=True) + "\n")
+
+
+def load(f):
+    """Read vectors written by dump.
+
+    Returns: A list of vector dicts with str values.
+    """
+    vectors = []
+    for line in f:
+        if not line.strip():
+            continue
+        vector = json.loads(line)
+        vectors.append({
+            "intermediate": str(vector["intermediate"]),
+            "slug": str(vector["slug"]),
+            "rerolls": int(vector["rerolls"]),
+            "password": str(vector["password"]),
+        })
+    return vectors